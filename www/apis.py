@@ -1,7 +1,7 @@
 '''
 JSON API definition.
 '''
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 # 用于存储分页信息
 class Page(object):
@@ -32,12 +32,50 @@ class Page(object):
         self.has_next = self.page_index < self.page_count
         # 这页之前是否还有上一页
         self.has_previous = self.page_index > 1
+        # 键集分页的游标,由调用者根据这页的首尾记录设置,客户端可以用它代替page翻页
+        self.next_cursor = None
+        self.prev_cursor = None
 
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
     __repr__ = __str__
 
+# 键集(seek)分页的游标: 把翻页方向、页码和边界记录的键值编码成不透明的字符串
+def encode_cursor(direction, page_index, values):
+    s = json.dumps([direction, page_index, list(values)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        direction, page_index, values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    if direction not in ('next', 'prev') or not isinstance(page_index, int) or not isinstance(values, list):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    # 边界记录的键值为(created_at, 主键),即handlers._seek_values()
+    if len(values) != 2 or isinstance(values[0], bool) or not isinstance(values[0], (int, float)) or not isinstance(values[1], str):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    return direction, max(page_index, 1), values
+
+# 用于键集分页,不需要item_count和offset,通过next_cursor/prev_cursor翻页
+class CursorPage(object):
+    '''
+    Page object for keyset (seek) pagination, which carries opaque cursors instead of offset.
+    '''
+    def __init__(self, page_index=1, page_size=2, has_next=False, has_previous=False, next_cursor=None, prev_cursor=None):
+        self.page_index = page_index
+        self.page_size = page_size
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __str__(self):
+        return 'page_index: %s, page_size: %s, next_cursor: %s, prev_cursor: %s' % (self.page_index, self.page_size, self.next_cursor, self.prev_cursor)
+
+    __repr__ = __str__
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
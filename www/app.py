@@ -1,15 +1,44 @@
 # -*- coding: utf-8 -*-
-import logging; logging.basicConfig(level=logging.INFO)   # 默认级别设置为INFO
+import logging, logging.handlers, queue, atexit, signal
 
-import asyncio, os, json, time
+from config import configs
+
+_log_listener = None
+
+# 初始化日志: 日志级别由配置决定(默认INFO)
+# queue为True时,记录日志只是把记录放入队列,由后台线程的QueueListener完成格式化和输出,不阻塞事件循环
+def init_logging(level='INFO', queue_size=-1, queue_handler=True):
+    global _log_listener
+    root = logging.getLogger()
+    root.setLevel(level)
+    # 重新初始化(比如fork出的worker进程中,父进程的后台线程不存在)时先移除原来的handler
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    if queue_handler:
+        q = queue.Queue(queue_size)
+        _log_listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+        handler = logging.handlers.QueueHandler(q)
+    root.addHandler(handler)
+
+# 在导入其他模块之前初始化,导入时的日志也按配置输出
+init_logging(**configs.logging)
+
+import asyncio, os, time, math, hashlib, gzip
 from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
 
 from aiohttp import web
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
-import orm
-from coroweb import add_routes, add_static
+import orm, render, serializer
+from cache import LRUCache, LocalCache, SocketCache
+from models import Blog, Comment
+from coroweb import add_routes, add_static, accepts_encoding
 
 from handlers import cookie2user, COOKIE_NAME
 
@@ -25,6 +54,9 @@ def init_jinja2(app, **kw):
         variable_end_string = kw.get('variable_end_string', '}}'),
         auto_reload = kw.get('auto_reload', True)   # 每当对模板发起请求,加载器首先检查模板是否发生改变.若是,则重载模板
     )
+    # 把编译后的字节码保存到文件系统,worker进程重启或重新部署后不必重新编译模板
+    if kw.get('bytecode_cache', False):
+        options['bytecode_cache'] = FileSystemBytecodeCache(kw.get('bytecode_cache_dir', None))
     path = kw.get('path', None)
     if path is None:
         # 若路径不存在,则将当前目录下的templates(www/templates/)设为jinja2的目录
@@ -32,7 +64,7 @@ def init_jinja2(app, **kw):
         # os.path.dirname(), 去掉文件名,返回目录路径
         # os.path.join(), 将分离的各部分组合成一个路径名
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
-    logging.info('set jinja2 template path: %s' % path)
+    logging.info('set jinja2 template path: %s', path)
     # 初始化jinja2环境, options参数,之前已经进行过设置
     # 加载器负责从指定位置加载模板, 此处选择FileSystemLoader,顾名思义就是从文件系统加载模板,前面我们已经设置了path
     env = Environment(loader=FileSystemLoader(path), **options)
@@ -41,6 +73,12 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    # 启动时预先编译所有模板,避免每个worker在第一次请求时才编译
+    if kw.get('precompile', False):
+        names = env.list_templates()
+        for name in names:
+            env.get_template(name)
+        logging.info('precompiled %s templates.', len(names))
     # 将jinja环境赋给app的__templating__属性
     app['__templating__'] = env
 
@@ -53,24 +91,36 @@ def init_jinja2(app, **kw):
 async def logger_factory(app, handler):
     async def logger(request):
         # 记录日志,包括http method, 和path
-        logging.info("Request: %s %s" % (request.method, request.path))
+        logging.info("Request: %s %s", request.method, request.path)
         # 日志记录完毕之后, 调用传入的handler继续处理请求
         return (await handler(request))
     return logger
 
+# debug模式下,统计每个请求中各种SQL语句的执行次数,同一种语句重复执行多次时记录警告(可能是N+1查询,应改用find_many/prefetch)
+async def query_factory(app, handler):
+    async def detect(request):
+        stats = orm.start_query_stats()
+        try:
+            return (await handler(request))
+        finally:
+            threshold = configs.orm.repeat_threshold
+            for sql, n in stats.items():
+                if n >= threshold:
+                    logging.warning('SQL executed %s times in %s %s: %s', n, request.method, request.path, sql)
+    return detect
+
 # 利用middle在处理URL之前，把cookie解析出来，并将登录用户绑定到request对象上,验证当前这个请求用户是否在登录状态下，或是否伪造的sha1
 async def auth_factory(app, handler):
     async def auth(request):
-        logging.info('check user: %s %s' % (request.method, request.path))
+        logging.debug('check user: %s %s', request.method, request.path)
         request.__user__ = None
         # 获取cookies
         cookie_str = request.cookies.get(COOKIE_NAME)
-        logging.info('cookie_str: %s' % cookie_str)
         if cookie_str:
             # 解密cookie:
             user = await cookie2user(cookie_str)
             if user:
-                logging.info('set current user: %s' % user.email)
+                logging.debug('set current user: %s', user.email)
                 # user存在则绑定到request上，说明当前用户是合法的
                 request.__user__ = user
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
@@ -88,23 +138,139 @@ async def data_factory(app, handler):
             # 将消息主体存入请求的__data__属性
             if request.content_type.startswith("application/json"):
                 request.__data__ = await request.json()
-                logging.info("request json: %s" % str(request.__data__))
+                logging.debug("request json: %s", request.__data__)
             # content type字段以application/x-www-form-urlencodeed打头的,是浏览器表单
             # request.post方法读取post来的消息主体,即表单信息
             elif request.content_type.startswith("application/x-www-form-urlencoded"):
                 request.__data__ = await request.post()
-                logging.info("request form: %s" % str(request.__data__))
+                logging.debug("request form: %s", request.__data__)
         # 调用传入的handler继续处理请求
         return (await handler(request))
     return parse_data
 
+# 匿名用户GET请求的整页缓存: path+query -> (headers, body),有效期很短
+_page_cache = LRUCache(configs.cache.page_size, configs.cache.page_ttl)
+# 正在生成的页面: path+query -> Future,同一个页面的并发请求只生成一次(single-flight)
+_page_pending = {}
+# 页面被清除的次数.生成页面期间发生清除时,生成的结果不放入缓存
+_page_generation = [0]
+
+def _page_cacheable(path):
+    return path == '/' or path.startswith('/blog/') or path.startswith('/api/blogs')
+
+# 博客或评论变化时清除相关的页面缓存.只清除当前进程的缓存,其他worker进程依靠很短的有效期
+def _purge_pages(op, obj):
+    _page_generation[0] += 1
+    if isinstance(obj, Comment):
+        blog_page = '/blog/%s' % obj.blog_id
+        _page_cache.pop_if(lambda key, entry: key.split('?')[0] == blog_page)
+    else:
+        blog_page = '/blog/%s' % obj.get('id')
+        _page_cache.pop_if(lambda key, entry: key == '/' or key.startswith('/?') or key.startswith('/api/blogs') or key.split('?')[0] == blog_page)
+
+async def _fill_page(handler, request, key):
+    generation = _page_generation[0]
+    resp = await handler(request)
+    # 只缓存完整生成的200响应
+    if type(resp) is web.Response and resp.status == 200 and isinstance(resp.body, bytes) and generation == _page_generation[0]:
+        headers = dict((k, v) for k, v in resp.headers.items() if k not in ('Content-Length', 'Date', 'Set-Cookie'))
+        _page_cache.set(key, (headers, resp.body))
+    return resp
+
+# 整页缓存,位于response_factory之前,缓存的是最终的响应内容
+async def cache_factory(app, handler):
+    async def cache(request):
+        if request.method != 'GET' or request.__user__ is not None or not _page_cacheable(request.path):
+            return (await handler(request))
+        key = request.path_qs
+        entry = _page_cache.get(key)
+        if entry is None:
+            fut = _page_pending.get(key)
+            if fut is None:
+                # 第一个请求负责生成页面
+                fut = _page_pending[key] = asyncio.ensure_future(_fill_page(handler, request, key))
+                fut.add_done_callback(lambda f: _page_pending.pop(key, None))
+                return (await asyncio.shield(fut))
+            # 其他并发的请求等待它的结果;结果不可缓存时自己生成
+            try:
+                await asyncio.shield(fut)
+            except Exception:
+                pass
+            entry = _page_cache.get(key)
+            if entry is None:
+                return (await handler(request))
+        headers, body = entry
+        if 'ETag' in headers and not_modified(request, headers['ETag'], None):
+            return web.Response(status=304, headers=dict((k, v) for k, v in headers.items() if k in ('ETag', 'Last-Modified')))
+        return web.Response(body=body, headers=headers)
+    return cache
+
+# 压缩过的页面: 内容的hash -> gzip后的内容,模板输出相同时不必重复压缩
+_gzip_cache = LRUCache(configs.compress.cache_size, configs.compress.cache_ttl)
+
+# 压缩动态响应: 客户端接受gzip、类型为html/json且超过一定大小时压缩,静态文件由add_static的处理函数负责
+async def compress_factory(app, handler):
+    async def compress(request):
+        resp = await handler(request)
+        if type(resp) is not web.Response or resp.status != 200 or 'Content-Encoding' in resp.headers:
+            return resp
+        body = resp.body
+        if not isinstance(body, bytes) or len(body) < configs.compress.min_size:
+            return resp
+        if not (resp.content_type.startswith('text/') or resp.content_type == 'application/json'):
+            return resp
+        resp.headers['Vary'] = 'Accept-Encoding'
+        if not accepts_encoding(request, 'gzip'):
+            return resp
+        key = hashlib.sha1(body).digest()
+        gz = _gzip_cache.get(key)
+        if gz is None:
+            gz = gzip.compress(body, configs.compress.level)
+            _gzip_cache.set(key, gz)
+        resp.body = gz
+        resp.headers['Content-Encoding'] = 'gzip'
+        # 不同编码的内容使用不同的强ETag,比较时去掉后缀
+        etag = resp.headers.get('ETag')
+        if etag:
+            resp.headers['ETag'] = etag[:-1] + '-gzip"'
+        return resp
+    return compress
+
+# 根据版本信息生成强ETag.页面中有当前用户的信息,所以不同用户的ETag不同
+def version_etag(request, last_modified, version=None):
+    user = request.__user__
+    s = '%s|%r|%s|%s' % (request.path_qs, last_modified, version or '', user.id if user else '')
+    return '"%s"' % hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+def validator_headers(etag, last_modified):
+    headers = {'ETag': etag}
+    if last_modified is not None:
+        headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    return headers
+
+# 客户端缓存的版本是否仍然有效: 优先比较If-None-Match,没有时比较If-Modified-Since
+def not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # 压缩后的响应ETag带有-gzip后缀(见compress_factory)
+        tags = [t.strip().replace('-gzip"', '"') for t in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    if last_modified is not None:
+        if_modified_since = request.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return int(last_modified) <= int(parsedate_to_datetime(if_modified_since).timestamp())
+            except (TypeError, ValueError):
+                return False
+    return False
+
 # 其将request handler的返回值转换为web.Response对象
 async def response_factory(app, handler):
     async def response(request):
-        logging.info(" response handler...")
+        logging.debug(" response handler...")
         # 调用handler来处理url请求,并返回响应结果.这是RequestHandler的__call__方法起的作用。
         r = await handler(request)
-        logging.info(" request handler end...")
+        logging.debug(" request handler end...")
         # 若响应结果为StreamResponse,直接返回
         # StreamResponse是aiohttp定义response的基类,即所有响应类型都继承自该类
         # StreamResponse主要为流式数据而设计
@@ -127,11 +293,28 @@ async def response_factory(app, handler):
         # 若响应结果为字典,则获取它的模板属性,此处为jinja2.env
         if isinstance(r, dict):
             template = r.get("__template__")
+            # 条件GET: handler给出了__last_modified__(以及可选的__etag__版本号)时,在渲染之前比较客户端缓存的版本
+            last_modified = r.pop("__last_modified__", None)
+            version = r.pop("__etag__", None)
+            etag = None
+            if last_modified is not None and request.method == "GET":
+                etag = version_etag(request, last_modified, version)
+                if not_modified(request, etag, last_modified):
+                    return web.Response(status=304, headers=validator_headers(etag, last_modified))
             # 若不存在对应模板,则将字典调整为json格式返回,并设置响应类型为json
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode("utf-8"))
+                # 很大的列表分块输出,没有ETag,也不压缩
+                if serializer.should_stream(r):
+                    resp = web.StreamResponse()
+                    resp.content_type = "application/json;charset=utf-8"
+                    resp.enable_chunked_encoding()
+                    await resp.prepare(request)
+                    for chunk in serializer.iter_dumps(r):
+                        await resp.write(chunk)
+                    await resp.write_eof()
+                    return resp
+                resp = web.Response(body=serializer.dumps(r))
                 resp.content_type = "application/json;charset=utf-8"
-                return resp
             # 存在对应模板的,则将套用模板,用request handler的结果进行渲染
             else:
                 #logging.info("request...%s" % request)
@@ -139,7 +322,14 @@ async def response_factory(app, handler):
                 # ??
                 resp = web.Response(body=app["__templating__"].get_template(template).render(**r).encode("utf-8"))
                 resp.content_type = "text/html;charset=utf-8"
-                return resp
+            if request.method == "GET":
+                # 没有版本信息的,用内容的hash作为ETag,至少可以节省传输
+                if etag is None:
+                    etag = '"%s"' % hashlib.sha1(resp.body).hexdigest()
+                    if not_modified(request, etag, None):
+                        return web.Response(status=304, headers=validator_headers(etag, None))
+                resp.headers.update(validator_headers(etag, last_modified))
+            return resp
         # 若响应结果为整型的
         # 此时r为状态码,即404,500等
         if isinstance(r, int) and r >= 100 and r<600:
@@ -183,20 +373,134 @@ def datetime_filter(t):
 # 初始化
 async def init(loop):
     # 创建全局数据库连接池
-    await orm.create_pool(loop = loop, host="127.0.0.1", port = 3306, user = "www-data", password = "www-data", db = "awesome", autocommit = True)
+    # 连接池大小、只读副本等都由configs.db配置
+    await orm.create_pool(loop = loop, **configs.db)
+    # 设置count缓存的有效期
+    orm.set_count_ttl(configs.cache.count_ttl)
+    # 设置Model.find的缓存
+    if configs.cache.find_backend == 'socket':
+        orm.set_find_cache(SocketCache(configs.cache.find_socket), configs.cache.find_ttl, configs.cache.find_negative_ttl)
+    elif configs.cache.find_backend == 'local':
+        # 只有一个进程时,进程内的缓存也能在写入时及时清除
+        orm.set_find_cache(LocalCache(configs.cache.find_size, configs.cache.find_ttl, coherent=worker_count() == 1), configs.cache.find_ttl, configs.cache.find_negative_ttl)
+    # 开启markdown渲染缓存
+    render.init(**configs.render)
+    # 选择json序列化的后端
+    serializer.init(**configs.json)
     # 创建web应用,
-    app = web.Application(loop = loop, middlewares=[logger_factory, auth_factory, response_factory]) # 创建一个循环类型是消息循环的web应用对象
+    middlewares = [logger_factory, auth_factory, compress_factory, cache_factory, response_factory]
+    # 博客或评论变化时清除相关的页面缓存
+    orm.on_change(Blog.__table__, _purge_pages)
+    orm.on_change(Comment.__table__, _purge_pages)
+    if configs.debug:
+        middlewares.insert(1, query_factory)
+    app = web.Application(loop = loop, middlewares=middlewares) # 创建一个循环类型是消息循环的web应用对象
     # 设置模板为jiaja2, 并以时间为过滤器
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+    init_jinja2(app, filters=dict(datetime=datetime_filter), **configs.templates)
     # 注册所有url处理函数
     add_routes(app, "handlers")
-    # 将当前目录下的static目录将如app目录
-    add_static(app)
-    # 调用子协程:创建一个TCP服务器,绑定到"127.0.0.1:9000"socket,并返回一个服务器对象
-    srv = await loop.create_server(app.make_handler(), "127.0.0.1", 9000)
-    logging.info("server started at http://127.0.0.1:9000")
-    return srv
-
-loop = asyncio.get_event_loop() # loop是一个消息循环对象
-loop.run_until_complete(init(loop)) #在消息循环中执行协程
-loop.run_forever()
+    # 将当前目录下的static目录将如app目录,模板中用static()引用带hash的静态文件url
+    static = add_static(app)
+    app['__templating__'].globals['static'] = static.url
+    # 调用子协程:创建一个TCP服务器,绑定到配置的地址和端口,并返回一个服务器对象
+    # 多个worker时使用reuse_port(SO_REUSEPORT),使它们可以监听同一个端口,由内核分配连接.
+    # 只有一个进程时不使用,不支持SO_REUSEPORT的平台也能运行,误启动的第二个实例也会因为端口被占用而失败
+    host, port = configs.server.host, configs.server.port
+    handler = app.make_handler()
+    srv = await loop.create_server(handler, host, port, reuse_port=True if worker_count() > 1 else None)
+    logging.info("server started at http://%s:%s (pid %s)", host, port, os.getpid())
+    return app, handler, srv
+
+# 优雅关闭: 停止接收新连接,等待处理中的请求完成,再关闭数据库连接池
+async def shutdown(app, handler, srv):
+    srv.close()
+    await srv.wait_closed()
+    await app.shutdown()
+    await handler.shutdown(configs.server.shutdown_timeout)
+    await app.cleanup()
+    await orm.close_pool()
+    orm.set_find_cache(None)
+    render.close()
+
+# 运行一个worker: 独立的事件循环、数据库连接池和app,收到SIGTERM/SIGINT后优雅关闭
+def run_worker():
+    loop = asyncio.new_event_loop() # loop是一个消息循环对象
+    asyncio.set_event_loop(loop)
+    app, handler, srv = loop.run_until_complete(init(loop)) #在消息循环中执行协程
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(shutdown(app, handler, srv))
+        loop.close()
+
+# 在子进程中运行worker,返回子进程的pid
+def spawn_worker():
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            # 父进程输出日志的后台线程不会被fork到子进程中,需要重新初始化
+            init_logging(**configs.logging)
+            run_worker()
+            code = 0
+        except BaseException as e:
+            logging.exception(e)
+        finally:
+            if _log_listener is not None:
+                _log_listener.stop()
+            os._exit(code)
+    return pid
+
+# 优雅关闭超过shutdown_timeout后,再等待多少秒才强制杀死worker
+_KILL_GRACE = 5
+
+# 配置的worker数,0表示CPU核数
+def worker_count():
+    return configs.server.workers or os.cpu_count() or 1
+
+# 入口: 启动配置的worker数(0表示CPU核数)的进程,重启意外退出的worker,收到SIGTERM时通知所有worker优雅退出
+def serve():
+    workers = worker_count()
+    if workers == 1:
+        run_worker()
+        return
+    children = set()
+    stopping = []
+    def kill(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+    def stop(signum, frame):
+        if not stopping:
+            # worker在shutdown_timeout内处理完请求,再留一点时间关闭连接池;超时仍未退出的worker强制杀死
+            signal.alarm(int(math.ceil(configs.server.shutdown_timeout)) + _KILL_GRACE)
+        stopping.append(signum)
+        kill(signal.SIGTERM, frame)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGALRM, lambda signum, frame: kill(signal.SIGKILL, frame))
+    for i in range(workers):
+        children.add(spawn_worker())
+    logging.info("supervisor %s started %s workers", os.getpid(), workers)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logging.warning("worker %s exited with status %s, restarting...", pid, status)
+            # 避免worker启动即失败时不停地fork
+            time.sleep(configs.server.restart_delay)
+            if not stopping:
+                children.add(spawn_worker())
+    logging.info("supervisor %s stopped", os.getpid())
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,223 @@
+'''
+In-process LRU cache with TTL, and cache backends for Model.find.
+'''
+import os, time, json, hashlib, asyncio, logging
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''
+    LRU cache bounded by maxsize, every entry expires after ttl seconds.
+    '''
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, 过期时间),OrderedDict的顺序即最近使用的顺序,最久未使用的在最前面
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[1] < time.time():
+            # 已过期
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        if key in self._data:
+            del self._data[key]
+        self._data[key] = (value, time.time() + (self.ttl if ttl is None else ttl))
+        # 超出容量则淘汰最久未使用的条目
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def pop_if(self, predicate):
+        # 删除所有predicate(key, value)为真的条目,返回删除的个数
+        keys = [k for k, (v, e) in self._data.items() if predicate(k, v)]
+        for k in keys:
+            del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and entry[1] >= time.time()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses, evictions=self.evictions, hit_ratio=(self.hits / total if total else 0.0))
+
+# ===================Model.find使用的缓存后端=====================
+# 后端的coherent属性表示清除是否对所有进程生效,即缓存中不会有其他worker修改前的旧数据
+# 后端需要提供: get(key)、set(key, value, ttl)、delete(key)、lease(key)和fill(key, token, value, ttl)五个协程, stats()和close()
+# value为数据库的一行(dict),空dict表示记录不存在(负缓存)
+# 未命中时先用lease(key)取得一个token再查询数据库,然后fill只在token仍然有效时写入;
+# 查询期间delete(key)使token作废,避免把查询开始前读到的旧数据写回缓存.同一个key同时只有一个lease
+
+class LocalCache(object):
+    '''
+    Cache backend in the current process, based on LRUCache.
+    Only coherent when the server runs in a single process.
+    '''
+    def __init__(self, maxsize=4096, ttl=60, lease_ttl=10, coherent=False):
+        self.coherent = coherent
+        self._cache = LRUCache(maxsize, ttl)
+        # key -> token,lease_ttl秒后过期,以免查询出错没有fill时该key一直不能写入
+        self._leases = LRUCache(maxsize, lease_ttl)
+
+    async def get(self, key):
+        return self._cache.get(key)
+
+    async def set(self, key, value, ttl=None):
+        self._cache.set(key, value, ttl)
+
+    async def delete(self, key):
+        self._cache.pop(key)
+        self._leases.pop(key)
+
+    async def lease(self, key):
+        if key in self._leases:
+            return None
+        token = object()
+        self._leases.set(key, token)
+        return token
+
+    async def fill(self, key, token, value, ttl=None):
+        if self._leases.pop(key) is not token:
+            return False
+        self._cache.set(key, value, ttl)
+        return True
+
+    def stats(self):
+        return dict(self._cache.stats(), backend='local')
+
+    def close(self):
+        self._cache.clear()
+        self._leases.clear()
+
+class SocketCache(object):
+    '''
+    Cache backend shared by all worker processes: a memcached compatible server on a local unix socket.
+    Errors are logged and treated as cache misses.
+    '''
+    # lease的占位条目使用的flags,get时当作未命中
+    LEASE_FLAGS = 1
+    coherent = True
+
+    def __init__(self, path, prefix='awesome:', timeout=0.5, lease_ttl=10):
+        self.path = path
+        self.prefix = prefix
+        self.timeout = timeout
+        self.lease_ttl = lease_ttl
+        self._reader = None
+        self._writer = None
+        # 一个连接上的命令依次执行,一个命令的请求和响应之间不能插入其他命令
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _key(self, key):
+        key = self.prefix + key
+        # memcached的key不能超过250字节,不能有空白字符
+        if len(key) > 200 or any(c.isspace() for c in key):
+            key = self.prefix + hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return key.encode('utf-8')
+
+    # key不为None时读取get/gets命令的响应,返回的值必须是这个key的,结果为(flags, 值, cas)或None
+    async def _exchange(self, request, key=None):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._writer.write(request)
+        line = await self._reader.readline()
+        if key is None:
+            return line
+        result = None
+        while line.startswith(b'VALUE '):
+            parts = line.split()
+            if parts[1] != key:
+                raise ValueError('unexpected key: %r' % parts[1])
+            size = int(parts[3])
+            data = (await self._reader.readexactly(size + 2))[:-2]
+            # gets的响应最后一项是cas
+            result = (int(parts[2]), data, parts[4] if len(parts) > 4 else None)
+            line = await self._reader.readline()
+        if line != b'END\r\n':
+            raise ValueError('unexpected response: %r' % line)
+        return result
+
+    async def _command(self, request, key=None):
+        async with self._lock:
+            try:
+                return (await asyncio.wait_for(self._exchange(request, key), self.timeout))
+            except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                self.errors += 1
+                logging.warning('cache server %s error: %s', self.path, e)
+                self.close()
+                return None
+            except BaseException:
+                # 被取消等情况下响应可能还没有读完,关闭连接,否则下一个命令会读到这次的响应
+                self.close()
+                raise
+
+    async def get(self, key):
+        key = self._key(key)
+        result = await self._command(b'get ' + key + b'\r\n', key)
+        if result is None or result[0] == self.LEASE_FLAGS:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(result[1].decode('utf-8'))
+
+    async def set(self, key, value, ttl=60):
+        data = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        await self._command(b'set %s 0 %d %d\r\n%s\r\n' % (self._key(key), max(1, int(ttl)), len(data), data))
+
+    async def delete(self, key):
+        await self._command(b'delete ' + self._key(key) + b'\r\n')
+
+    # 用add写入占位条目,只有一个worker能成功;delete会删除占位条目
+    async def lease(self, key):
+        token = os.urandom(8).hex().encode('ascii')
+        line = await self._command(b'add %s %d %d %d\r\n%s\r\n' % (self._key(key), self.LEASE_FLAGS, self.lease_ttl, len(token), token))
+        return token if line == b'STORED\r\n' else None
+
+    # 占位条目还是自己的时,用cas替换为查询结果;期间被delete或再次add过则cas失败
+    async def fill(self, key, token, value, ttl=60):
+        key = self._key(key)
+        result = await self._command(b'gets ' + key + b'\r\n', key)
+        if result is None or result[0] != self.LEASE_FLAGS or result[1] != token or result[2] is None:
+            return False
+        data = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        line = await self._command(b'cas %s 0 %d %d %s\r\n%s\r\n' % (key, max(1, int(ttl)), len(data), result[2], data))
+        return line == b'STORED\r\n'
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(backend='socket', hits=self.hits, misses=self.misses, errors=self.errors, hit_ratio=(self.hits / total if total else 0.0))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
@@ -1,14 +1,77 @@
 #开发环境的标准配置
 configs = {
     'debug': True,
+    'logging': {   # 定义日志信息
+        'level': 'INFO',          # 日志级别,生产环境可设为WARNING
+        'queue_size': -1,         # 日志队列的大小,小于等于0表示不限制
+        'queue_handler': True     # 是否通过队列由后台线程输出日志,不阻塞事件循环
+    },
+    'server': {    # 定义服务器信息
+        'host': '127.0.0.1',
+        'port': 9000,
+        'workers': 0,             # worker进程数,0表示CPU核数,1表示只在当前进程中运行
+        'restart_delay': 1,       # worker意外退出后,等待多少秒再重启
+        'shutdown_timeout': 10    # 优雅关闭时等待处理中的请求的时间(秒)
+    },
     'db': {    # 定义数据库相关信息
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        'autocommit': True,
+        'maxsize': 10,                  # 连接池的最大连接数
+        'minsize': 1,                   # 连接池的最小连接数
+        'acquire_timeout': 0,           # 从连接池获取连接的超时时间(秒),0表示一直等待
+        'adaptive': False,              # 是否根据等待时间自动调整最大连接数
+        'adaptive_max': 30,             # 自动调整时最大连接数的上限,下限为minsize
+        'adaptive_interval': 10,        # 自动调整的间隔(秒)
+        'adaptive_wait': 0.01,          # 平均等待时间超过该值(秒)时增加连接数
+        'warmup': 4,                    # 启动时预先建立的连接数(不超过maxsize),0表示不预热
+        'ping_interval': 30,            # 检查空闲连接的间隔(秒),0表示不检查
+        'idle_ping': 60,                # 空闲超过该时间(秒)的连接会被ping,坏掉的连接被关闭并补充
+        'replicas': [],                 # 只读副本,每一项覆盖上面的配置,如 {'host': '10.0.0.2'}
+        'read_strategy': 'round_robin', # 选择副本的方式: round_robin(轮流)或least_busy(使用中的连接最少)
+        'read_your_writes': 1,          # 请求中写入数据后,该时间(秒)内的读操作发往主库
+        'replica_retry': 5              # 副本出错后,暂停使用的时间(秒),期间读操作发往主库
     },
     'session': {   # 定义会话信息
-        'secret': 'Awesome'
+        'secret': 'Awesome'   # 登录用户由User.find读取,多个worker时只使用socket后端的find缓存,见cache.find_*
+    },
+    'cache': {     # 定义缓存信息
+        'count_ttl': 60,   # count(id)等计数结果的缓存时间(秒),0表示不缓存
+        'page_size': 1024, # 匿名用户页面缓存的条目数,0表示不缓存
+        'page_ttl': 5,     # 匿名用户页面缓存的有效期(秒)
+        'find_backend': 'local',  # Model.find的缓存: local(进程内LRU),socket(本机memcached,各worker共享),空字符串表示不缓存
+        'find_size': 4096,        # local缓存的条目数
+        'find_ttl': 60,           # 缓存的有效期(秒).local后端只清除当前worker的缓存,其他worker中的修改最多在这段时间后可见,
+                                  # 所以多个worker时验证登录用户不使用local缓存;需要立即生效时使用socket后端
+        'find_negative_ttl': 5,   # 不存在的记录的缓存有效期(秒)
+        'find_socket': '/var/run/memcached/memcached.sock'  # socket缓存的unix socket路径
+    },
+    'compress': {  # 定义响应压缩信息
+        'min_size': 1024,     # 超过该大小(字节)的html/json响应才压缩
+        'level': 6,           # gzip压缩级别
+        'cache_size': 256,    # 压缩结果缓存的条目数
+        'cache_ttl': 600      # 压缩结果缓存的有效期(秒)
+    },
+    'templates': { # 定义jinja2模板信息
+        'auto_reload': True,        # 每次渲染前检查模板文件是否修改,生产环境应关闭
+        'bytecode_cache': False,    # 是否把编译后的模板字节码缓存到文件系统
+        'bytecode_cache_dir': None, # 字节码缓存的目录,None表示系统临时目录
+        'precompile': False         # 启动时预先编译所有模板
+    },
+    'json': {      # 定义json序列化信息
+        'backend': 'auto',    # auto/orjson/ujson/json,auto表示使用已安装的最快的后端
+        'chunk_items': 1000   # 列表超过该条目数时分块输出,0表示不分块
+    },
+    'orm': {       # 定义ORM信息
+        'repeat_threshold': 5   # debug模式下,同一种SQL语句在一个请求中执行达到该次数时记录警告(N+1查询)
+    },
+    'render': {    # 定义markdown渲染信息
+        'cache_size': 256,              # 每个渲染进程中渲染结果缓存的条目数,0表示不缓存,统计信息见/api/stats/cache
+        'cache_chars': 8 * 1024 * 1024, # 渲染结果缓存的html总字符数上限
+        'workers': 2,                   # 渲染进程池的大小,0表示在事件循环中直接渲染
+        'timeout': 3                    # 等待渲染的最长时间(秒),超时则显示转义后的纯文本
     }
 }
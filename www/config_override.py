@@ -4,5 +4,10 @@
 configs = {
     "db": { # 重载的数据库信息,将会覆盖默认的数据库相关配置信息
         "host": "127.0.0.1"
+        },
+    "templates": { # 生产环境不检查模板修改,启动时预先编译并缓存字节码
+        "auto_reload": False,
+        "bytecode_cache": True,
+        "precompile": True
         }
     }
@@ -1,6 +1,5 @@
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging, functools, mimetypes, hashlib
 
-from urllib import parse
 from aiohttp import web
 from apis import APIError
 
@@ -99,6 +98,11 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)     #是否带有命名关键字参数
         self._named_kw_args = get_named_kw_args(fn)         #获取命名关键字参数
         self._required_kw_args = get_required_kw_args(fn)   #获取函数的值为空的命名关键字
+        # 参数绑定方案,在add_route时计算一次,每个请求按它直接把query/body/match_info填入调用参数
+        # _parse_params: 是否需要解析query或body
+        # _accepted: None表示接收全部参数(**kw),否则只取这些命名关键字参数
+        self._parse_params = bool(self._has_var_kw_arg or self._has_named_kw_args)
+        self._accepted = None if self._has_var_kw_arg else self._named_kw_args
 
     # 定义了__call__,则其实例可以被视为函数
     # 此处参数为request
@@ -107,80 +111,59 @@ class RequestHandler(object):
     #           return web.Response()
     #       app.router.add_route('*', '/path', handler)
     async def __call__(self, request):
-        kw = None # 设不存在关键字参数
+        kw = {}
         # 存在关键字参数/命名关键字参数
-        if self._has_var_kw_arg or self._has_named_kw_args:
+        if self._parse_params:
+            params = None
+            method = request.method
             # http method 为 post的处理
-            if request.method == "POST":
+            if method == "POST":
                 # http method 为post, 但request的content type为空, 返回丢失信息
                 if not request.content_type:
                     return web.HTTPBadRequest("Missing Content-Type")
                 ct = request.content_type.lower() # 获得content type字段
-                # 用于测试：
-                logging.info('content_type:%s' % ct)
-                # 以下为检查post请求的content type字段
                 # application/json表示消息主体是序列化后的json字符串
                 if ct.startswith("application/json"):
                     params = await request.json() # request.json方法的作用是读取request body, 并以json格式解码
                     if not isinstance(params, dict): # 解码得到的参数不是字典类型, 返回提示信息
                         return web.HTTPBadRequest("JSON body must be object.")
-                    kw = params # post, content type字段指定的消息主体是json字符串,且解码得到参数为字典类型的,将其赋给变量kw
                 # 以下2种content type都表示消息主体是表单
                 elif ct.startswith("application/x-www-form-urlencoded") or ct.startswith("multipart/form-data"):
-                    # request.post方法从request body读取POST参数,即表单信息,并包装成字典赋给kw变量
-                    # A MultiDict with the parsed form data from POST or PUT requests.
+                    # request.post方法从request body读取POST参数,即表单信息(MultiDict)
                     params = await request.post()
-                    # MultiDict saves all values for a key as a list
-                    kw = dict(**params)
                 else:
                     # 此处我们只处理以上三种post 提交数据方式
                     return web.HTTPBadRequest("Unsupported Content-Type: %s" % request.content_type)
-                # 用于测试：
-                for k,v in kw.items():
-                    logging.info('kw[%s]:%s' % (k,v))
             # http method 为 get的处理
-            if request.method == "GET":
-                # request.query_string表示url中的查询字符串
-                qs = request.query_string
-                # 用于测试：
-                logging.info('query_string: %s' % qs)
-                if qs:
-                    kw = dict() # 原来为None的kw变成字典
-                    # parse.parse_qs(qs, True)
-                    # Data are returned as a dictionary. The dictionary keys are the unique query variable names and the values are lists of values for each name.
-                    for k, v in parse.parse_qs(qs, True).items(): # 解析query_string,以字典的形如储存到kw变量中
-                        # 用于测试：
-                        logging.info('解析query_string ==> k:%s,v:%s' % (k,v))
-                        # v[0]取lists中的第一个值
-                        kw[k] = v[0]
-        if kw is None: # 经过以上处理, kw仍为空,即以上全部不匹配。有一种情况是有些get方式不存在关键字参数,则kw还是None
-            # 理解request.match_info
-            kw = dict(**request.match_info)
-        else:
-            # kw 不为空,且requesthandler只存在命名关键字的,则只取命名关键字参数名放入kw
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # 删除所有没有命名的关键字参数
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # 遍历request.match_info(abstract math info), 若其key又存在于kw中,发出重复参数警告
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning("Duplicate arg name in named arg and kw args: %s" % k)
-                # 用math_info的值覆盖kw中的原值
-                kw[k] = v
+            elif method == "GET":
+                # request.query是aiohttp解析好的查询字符串(MultiDict),同名参数取第一个值
+                params = request.query
+            if params:
+                accepted = self._accepted
+                if accepted is None:
+                    kw.update(params)
+                else:
+                    # requesthandler只存在命名关键字的,则只取命名关键字参数
+                    for name in accepted:
+                        if name in params:
+                            kw[name] = params[name]
+        # request.match_info为url路径中的参数,若其key又存在于kw中,发出重复参数警告,并用math_info的值覆盖kw中的原值
+        match_info = request.match_info
+        if match_info:
+            if kw:
+                for k in match_info:
+                    if k in kw:
+                        logging.warning("Duplicate arg name in named arg and kw args: %s", k)
+            kw.update(match_info)
         # 若存在"request"关键字, 则添加
         if self._has_request_arg:
             kw["request"] = request
         # 若存在未指定值的命名关键字参数,且参数名未在kw中,返回丢失参数信息
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    #return web.HTTPBadRequest()
-                     return web.HTTPBadRequest("Missing argument: %s" % name)
-        logging.info("call with args: %s" % str(kw))
+        for name in self._required_kw_args:
+            if name not in kw:
+                return web.HTTPBadRequest("Missing argument: %s" % name)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("call with args: %s", kw)
         # 以上过程即为从request中获得必要的参数
 
         # 以下调用handler处理,并通过中间件response_factory处理返回response.
@@ -190,13 +173,74 @@ class RequestHandler(object):
         except APIError as e:
             return dict(error = e.error, data = e.data, message = e.message)
 
-# 添加静态页面的路径
+# 客户端是否接受某种Content-Encoding,如 Accept-Encoding: gzip, deflate;q=0.5
+def accepts_encoding(request, encoding):
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = item.partition(';')
+        if name.strip().lower() in (encoding, '*'):
+            q = params.strip()
+            if q.startswith('q='):
+                try:
+                    return float(q[2:]) > 0
+                except ValueError:
+                    return False
+            return True
+    return False
+
+# 静态文件的处理函数.启动时扫描一遍目录,请求时不必检查文件是否存在,也避免了路径穿越
+# 有预先压缩好的.gz文件(见gzip_static.py)且客户端接受gzip时,直接返回.gz文件
+# 同时为每个文件生成带内容hash的文件名(manifest),如js/vue.min.js => js/vue.min.1a2b3c4d5e.js,
+# 模板中用{{ static('js/vue.min.js') }}引用.文件内容变化时url随之变化,所以带hash的url可以永久缓存
+class StaticHandler(object):
+    def __init__(self, path, prefix='/static/'):
+        self._prefix = prefix
+        self._files = dict()
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                full = os.path.join(root, name)
+                self._files[os.path.relpath(full, path).replace(os.sep, '/')] = full
+        self._manifest = dict()
+        self._hashed = dict()
+        for filename, full in self._files.items():
+            if filename.endswith('.gz'):
+                continue
+            with open(full, 'rb') as f:
+                digest = hashlib.md5(f.read()).hexdigest()[:10]
+            base, ext = os.path.splitext(filename)
+            hashed = '%s.%s%s' % (base, digest, ext)
+            self._manifest[filename] = hashed
+            self._hashed[hashed] = filename
+        logging.info('static manifest: %s files.', len(self._manifest))
+
+    # 返回文件的url,不在static目录下的文件原样返回
+    def url(self, filename):
+        return self._prefix + self._manifest.get(filename, filename)
+
+    async def __call__(self, request):
+        filename = request.match_info['filename']
+        headers = {'Vary': 'Accept-Encoding'}
+        if filename in self._hashed:
+            filename = self._hashed[filename]
+            headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        path = self._files.get(filename)
+        if path is None:
+            raise web.HTTPNotFound()
+        gz = self._files.get(filename + '.gz')
+        if gz is not None and accepts_encoding(request, 'gzip'):
+            headers['Content-Type'] = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            headers['Content-Encoding'] = 'gzip'
+            path = gz
+        return web.FileResponse(path, headers=headers)
+
+# 添加静态页面的路径,返回StaticHandler,用于在模板中生成静态文件的url
 def add_static(app):
     # __file__
-    logging.info('__file__ :[%s]' % __file__)
+    logging.info('__file__ :[%s]', __file__)
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
-    logging.info('add static %s => %s' % ('/static/', path))
+    static = StaticHandler(path, '/static/')
+    app.router.add_route('GET', '/static/{filename:.+}', static)
+    logging.info('add static %s => %s', '/static/', path)
+    return static
 
 # 将url处理函数注册到app上
 # 处理将针对http method 和path进行
@@ -208,10 +252,10 @@ def add_route(app, fn):
     # 将非协程或生成器的函数变为一个协程.url函数在经过get和post装饰之后返回的是wrapper函数,即为此处的fn。
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         # 用于测试：
-        logging.info(' %s is not a coroutinefunction ' % fn.__name__)
+        logging.info(' %s is not a coroutinefunction ', fn.__name__)
         fn = asyncio.coroutine(fn)
     # url 处理函数
-    logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
+    logging.info('add route %s %s => %s(%s)', method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys()))
     # INFO:root:add route POST /api/blogs => api_create_blog(request, name, summary, content)
     # INFO:root:add route GET /api/blogs => api_blogs(page)
 
@@ -243,7 +287,7 @@ def add_routes(app, module_name):
         name = module_name[n+1:]
         mod = getattr(__import__(module_name[:n], globals(), locals(), [name]), name)
     # 用于测试：如果要获得一个对象的所有属性和方法，可以使用dir()函数，它返回一个包含字符串的list.
-    logging.info(' dir(mod): %s ' % dir(mod))
+    logging.info(' dir(mod): %s ', dir(mod))
     # INFO:root: dir(mod): ['APIResourceNotFoundError', 'APIValueError', 'Blog', 'COOKIE_NAME', 'Comment', 'Page', 'User',
     #'_COOKIE_KEY', '_RE_EMAIL', '_RE_SHA1', '__builtins__', '__cached__', '__doc__', '__file__', '__loader__', '__name__',
     #'__package__', '__spec__', 'api_blogs', 'api_comments', 'api_create_blog', 'api_create_comment', 'api_delete_blog',
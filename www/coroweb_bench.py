@@ -0,0 +1,86 @@
+'''
+Benchmark: requests/s of RequestHandler on a trivial @get route, without
+network I/O (the request is built with aiohttp.test_utils). Compares the
+previous per-request argument binding (LegacyRequestHandler) with the
+current precomputed one.
+
+    python3 coroweb_bench.py
+'''
+import asyncio, time, logging
+
+from urllib import parse
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from apis import APIError
+from coroweb import get, RequestHandler, has_request_arg, has_var_kw_arg, has_named_kw_args, get_named_kw_args, get_required_kw_args
+
+# 原来的RequestHandler(只保留GET的处理),每个请求都重新解析query_string并逐项判断参数
+class LegacyRequestHandler(object):
+    def __init__(self, app, fn):
+        self._app = app
+        self._func = fn
+        self._has_request_arg = has_request_arg(fn)
+        self._has_var_kw_arg = has_var_kw_arg(fn)
+        self._has_named_kw_args = has_named_kw_args(fn)
+        self._named_kw_args = get_named_kw_args(fn)
+        self._required_kw_args = get_required_kw_args(fn)
+
+    async def __call__(self, request):
+        kw = None
+        if self._has_var_kw_arg or self._has_named_kw_args:
+            if request.method == "GET":
+                qs = request.query_string
+                logging.info('query_string: %s' % qs)
+                if qs:
+                    kw = dict()
+                    for k, v in parse.parse_qs(qs, True).items():
+                        logging.info('解析query_string ==> k:%s,v:%s' % (k,v))
+                        kw[k] = v[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if not self._has_var_kw_arg and self._named_kw_args:
+                copy = dict()
+                for name in self._named_kw_args:
+                    if name in kw:
+                        copy[name] = kw[name]
+                kw = copy
+            for k, v in request.match_info.items():
+                if k in kw:
+                    logging.warning("Duplicate arg name in named arg and kw args: %s" % k)
+                kw[k] = v
+        if self._has_request_arg:
+            kw["request"] = request
+        if self._required_kw_args:
+            for name in self._required_kw_args:
+                if not name in kw:
+                    return web.HTTPBadRequest()
+        logging.info("call with args: %s" % str(kw))
+        try:
+            r = await self._func(**kw)
+            return r
+        except APIError as e:
+            return dict(error = e.error, data = e.data, message = e.message)
+
+@get('/api/blogs/{id}')
+async def api_bench(id, *, page='1', size='10'):
+    return id
+
+async def bench(handler_class, n=100000):
+    handler = handler_class(web.Application(), api_bench)
+    request = make_mocked_request('GET', '/api/blogs/123?page=2&size=20&other=x', match_info={'id': '123'})
+    for i in range(1000):
+        await handler(request)
+    start = time.perf_counter()
+    for i in range(n):
+        await handler(request)
+    return n / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.new_event_loop()
+    for name, cls in (('legacy', LegacyRequestHandler), ('current', RequestHandler)):
+        print('%-8s %8.0f requests/s' % (name, max(loop.run_until_complete(bench(cls)) for i in range(3))))
+    loop.close()
@@ -0,0 +1,36 @@
+'''
+Build step: write a precompressed .gz sibling for every compressible file
+under www/static, the static handler serves it directly when the client
+accepts gzip.
+
+    python3 gzip_static.py
+'''
+import os, gzip, logging; logging.basicConfig(level=logging.INFO)
+
+# 已经压缩过的格式(图片、woff字体等)再压缩没有意义
+COMPRESSIBLE = ('.css', '.js', '.html', '.svg', '.txt', '.json', '.otf', '.ttf', '.eot')
+
+def gzip_static(path):
+    n = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            src = os.path.join(root, name)
+            dst = src + '.gz'
+            # 源文件没有变化的不重新压缩
+            if os.path.isfile(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+                continue
+            with open(src, 'rb') as f:
+                data = f.read()
+            gz = gzip.compress(data, 9)
+            if len(gz) >= len(data):
+                continue
+            with open(dst, 'wb') as f:
+                f.write(gz)
+            n = n + 1
+            logging.info('%s: %s => %s bytes', dst, len(data), len(gz))
+    logging.info('compressed %s files.', n)
+
+if __name__ == '__main__':
+    gzip_static(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
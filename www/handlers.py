@@ -1,14 +1,16 @@
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, logging, hashlib, base64, asyncio
 
 from coroweb import get, post
 
 from aiohttp import web
 from models import User, Comment, Blog, next_id
 
-from apis import APIValueError, APIResourceNotFoundError, Page
+from apis import APIValueError, APIResourceNotFoundError, APIPermissionError, Page, CursorPage, encode_cursor, decode_cursor
 
 from config import configs
-import markdown2
+import orm, serializer
+import render
+from render import render_blog_async, is_stale, text2html
 # 如果一个URL返回的不是HTML，而是机器能直接解析的数据，这个URL就可以看成是一个Web API。
 # 由于API就是把Web App的功能全部封装了，所以，通过API操作数据，可以极大地把前端和后端的代码隔离，使得后端代码易于测试，前端代码编写更简单。
 
@@ -16,10 +18,6 @@ COOKIE_NAME = 'awesession'
 # 将配置中的默认字典类型转换为自定义字典类型，可通过a.b进行访问
 _COOKIE_KEY = configs.session.secret
 
-def text2html(text):
-    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
-    return ''.join(lines)
-
 #@get('/')
 #async def index(request):
 #    users = await User.findAll()
@@ -44,8 +42,6 @@ async def cookie2user(cookie_str):
     '''
     Parse cookie and load user if cookie is valid.
     '''
-    logging.info('cookie_str :[%s]' % cookie_str)
-
     if not cookie_str:
         return None
     try:
@@ -56,7 +52,9 @@ async def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
-        user = await User.find(uid)
+        # 用户被删除、取消管理员或修改密码后必须立即生效: 只在find缓存能在所有worker中失效时使用缓存
+        # (socket后端,或者只有一个进程),否则直接查询数据库
+        user = await User.find(uid, strict=True)
         if user is None:
             return None
         s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
@@ -85,20 +83,10 @@ async def cookie2user(cookie_str):
 
 # 首页
 @get('/')
-async def index(*, page='1'):
-    # 获取到要展示的博客页数是第几页
-    page_index = get_page_index(page)
-    # 查找博客表里的条目数
-    num = await Blog.findNumber('count(id)')
-    # 通过Page类来计算当前页的相关信息
-    page = Page(num, page_index)
-    # 如果表里没有条目，则不需要显示
-    if num == 0:
-        blogs = []
-    else:
-        # 否则，根据计算出来的offset(取的初始条目index)和limit(取的条数)，来取出条目
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
-        # 返回给浏览器
+async def index(*, page='1', cursor=None):
+    # 通过page计算offset(取的初始条目index)和limit(取的条数),或者通过cursor做键集分页,来取出条目
+    page, blogs = await find_page(Blog, page, cursor, defer=BLOG_LIST_DEFER)
+    # 返回给浏览器
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -155,7 +143,7 @@ async def authenticate(*, email, passwd):
     # web间数据传递的密码隐藏为******
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 #@get('/api/users')
@@ -166,13 +154,10 @@ async def authenticate(*, email, passwd):
 #    return dict(users=users)
 
 @get('/api/users')
-async def api_get_users(*, page='1'):
-    page_index = get_page_index(page)
-    num = await User.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
+async def api_get_users(*, page='1', cursor=None):
+    p, users = await find_page(User, page, cursor)
+    if not users:
         return dict(page=p, users=())
-    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
     for u in users:
         u.passwd = '******'
     return dict(page=p, users=users)
@@ -205,7 +190,7 @@ async def api_register_user(*, email, name, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 # 检查登录用户是否为管理员
@@ -236,6 +221,8 @@ async def api_create_blog(request, *, name, summary, content):
         raise APIValueError('content', 'content cannot be empty.')
     # 构建博客数据
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
+    # 预先渲染正文,查看博客时不必再渲染
+    await render_blog_async(blog)
     # 保存
     await blog.save()
     return blog
@@ -251,15 +238,47 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 博客列表只需要标题、摘要等,不取出正文
+BLOG_LIST_DEFER = ('content', 'html_content')
+
+# 键集分页使用的排序键: created_at加主键,保证顺序唯一
+def _seek_values(item):
+    return [item.created_at, item[item.__primary_key__]]
+
+# 按created_at倒序分页查询,返回(page, items)
+# 有cursor时使用键集(seek)分页,不再计算offset,也不需要count;否则按page计算offset,同时给出可以继续翻页的游标
+# 其余关键字参数(如defer)传给findAll
+async def find_page(cls, page='1', cursor=None, page_size=2, **kw):
+    if cursor:
+        direction, page_index, values = decode_cursor(cursor)
+        if direction == 'next':
+            items = await cls.findAll(after=values, limit=page_size + 1, **kw)
+            has_next, has_previous = len(items) > page_size, page_index > 1
+            items = items[:page_size]
+        else:
+            items = await cls.findAll(before=values, limit=page_size + 1, **kw)
+            has_next, has_previous = True, len(items) > page_size
+            items = items[-page_size:]
+        p = CursorPage(page_index, page_size, has_next, has_previous)
+    else:
+        page_index = get_page_index(page)
+        num = await cls.findNumber('count(id)')
+        p = Page(num, page_index, page_size)
+        if num == 0 or p.limit == 0:
+            return p, []
+        items = await cls.findAll(orderBy='created_at desc, `%s` desc' % cls.__primary_key__, limit=(p.offset, p.limit), **kw)
+    if items and p.has_next:
+        p.next_cursor = encode_cursor('next', p.page_index + 1, _seek_values(items[-1]))
+    if items and p.has_previous:
+        p.prev_cursor = encode_cursor('prev', p.page_index - 1, _seek_values(items[0]))
+    return p, items
+
 # 获取博客信息
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
+async def api_blogs(*, page='1', cursor=None):
+    p, blogs = await find_page(Blog, page, cursor, defer=BLOG_LIST_DEFER)
+    if not blogs:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
     return dict(page=p, blogs=blogs)
 
 # 博客管理页面
@@ -285,13 +304,10 @@ def manage_comments(*, page='1'):
 
 # 根据page获取评论
 @get('/api/comments')
-async def api_comments(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Comment.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
+async def api_comments(*, page='1', cursor=None):
+    p, comments = await find_page(Comment, page, cursor)
+    if not comments:
         return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
     return dict(page=p, comments=comments)
 
 @post('/api/blogs/{id}/comments')
@@ -319,7 +335,7 @@ async def api_create_comment(id, request, *, content):
 @post('/api/comments/{id}/delete')
 async def api_delete_comments(id, request):
     # 删除某个评论
-    logging.info(id)
+    logging.info('delete comment: %s', id)
     # 先检查是否是管理员操作，只有管理员才有删除评论权限
     check_admin(request)
     # 查询一下评论id是否有对应的评论
@@ -327,8 +343,10 @@ async def api_delete_comments(id, request):
     # 没有的话抛出错误
     if c is None:
         raise APIResourceNotFoundError('Comment')
-    # 有的话删除
-    await c.remove()
+    # 有的话删除,同时更新博客的修改时间,博客页面的Last-Modified随之变化
+    async with orm.transaction():
+        await c.remove()
+        await Blog(id=c.blog_id, updated_at=time.time()).update_fields(('updated_at',))
     return dict(id=id)
 
 @get('/blog/{id}')
@@ -337,13 +355,19 @@ async def get_blog(id):
     blog = await Blog.find(id)
     # 根据博客id查询该条博客的评论
     comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
-    # markdown2是个扩展模块，这里把博客正文和评论套入到markdon中
     for c in comments:
         c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
-    # 返回页面
+    # 博客正文的html在发表和修改时已经渲染好,只有旧数据或渲染器版本变化时才需要渲染,渲染后顺便保存
+    # 渲染在进程池中进行,不阻塞事件循环;超时则暂时显示转义后的纯文本,不保存
+    # 只写入html的两列和修改时间,且只在正文没有被修改时写入,不会覆盖同时进行的修改
+    if is_stale(blog) and (await render_blog_async(blog)):
+        blog.updated_at = time.time()
+        await blog.update_fields(('html_content', 'html_version', 'updated_at'), 'content=?', [blog.content])
+    # 返回页面.页面的最后修改时间为博客和评论中最晚的修改时间,渲染器版本变化时ETag也随之变化
     return {
         '__template__': 'blog.html',
+        '__last_modified__': max([blog.updated_at or blog.created_at] + [c.created_at for c in comments]),
+        '__etag__': blog.html_version,
         'blog': blog,
         'comments': comments
     }
@@ -352,12 +376,14 @@ async def get_blog(id):
 async def api_get_blog(*, id):
     # 获取某条博客的信息
     blog = await Blog.find(id)
+    if blog is not None:
+        blog['__last_modified__'] = blog.updated_at or blog.created_at
     return blog
 
 @post('/api/blogs/{id}/delete')
 async def api_delete_blog(id, request):
     # 删除一条博客
-    logging.info("删除博客的博客ID为：%s" % id)
+    logging.info("删除博客的博客ID为：%s", id)
     # 先检查是否是管理员操作，只有管理员才有删除评论权限
     check_admin(request)
     # 查询一下评论id是否有对应的评论
@@ -365,8 +391,10 @@ async def api_delete_blog(id, request):
     # 没有的话抛出错误
     if b is None:
         raise APIResourceNotFoundError('Comment')
-    # 有的话删除
-    await b.remove()
+    # 有的话在同一个事务中删除博客和它的评论
+    async with orm.transaction():
+        await Comment.remove_where('blog_id=?', [id])
+        await b.remove()
     return dict(id=id)
 
 @post('/api/blogs/modify')
@@ -386,6 +414,8 @@ async def api_modify_blog(request, *, id, name, summary, content):
     blog.name = name
     blog.summary = summary
     blog.content = content
+    blog.updated_at = time.time()
+    await render_blog_async(blog)
 
     # 保存
     await blog.update()
@@ -399,3 +429,15 @@ def manage_modify_blog(id):
         'id': id,
         'action': '/api/blogs/modify'
     }
+
+# 数据库连接池的统计信息: 等待时间直方图、使用中/空闲的连接数、超时次数、连接的创建和关闭次数
+@get('/api/stats/pool')
+def api_pool_stats(request):
+    check_admin(request)
+    return dict(pools=orm.pool_stats())
+
+# 缓存的命中率等统计信息,用于调整缓存的大小
+@get('/api/stats/cache')
+def api_cache_stats(request):
+    check_admin(request)
+    return dict(find=orm.find_cache_stats(), render=render.cache_stats())
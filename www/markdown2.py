@@ -101,6 +101,7 @@ except ImportError:
 import optparse
 from random import random, randint
 import codecs
+from collections import OrderedDict
 
 
 #---- Python version compat
@@ -259,6 +260,31 @@ class Markdown(object):
 
     def convert(self, text):
         """Convert the given text."""
+        if _render_cache is None:
+            return self._convert(text)
+        key = self._render_cache_key(text)
+        rv = _render_cache.get(key)
+        if rv is None:
+            rv = self._convert(text)
+            _render_cache.put(key, rv)
+        return rv
+
+    def _render_cache_key(self, text):
+        # Everything that can change the output for the same text: the
+        # (sub)class, the extras given at construction time and the
+        # other constructor options.
+        settings = repr((self.__class__.__module__, self.__class__.__name__,
+                         sorted(self._instance_extras.items()),
+                         self.safe_mode, self.tab_width,
+                         self.empty_element_suffix, self.link_patterns,
+                         self.use_file_vars))
+        h = md5(settings.encode("utf-8"))
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        h.update(text)
+        return h.hexdigest()
+
+    def _convert(self, text):
         # Main function. The order in which other subs are called here is
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
@@ -2013,6 +2039,75 @@ class MarkdownWithExtras(Markdown):
     extras = ["footnotes", "code-color"]
 
 
+#---- render cache
+
+class _RenderCache(object):
+    """An LRU cache of conversion results, keyed by a hash of the text and
+    the conversion options. It is bounded both by the number of entries and
+    by the total number of characters of the cached HTML.
+    """
+    def __init__(self, maxsize, max_chars):
+        self.maxsize = maxsize
+        self.max_chars = max_chars
+        self.chars = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        rv = self._data.pop(key, None)
+        if rv is None:
+            self.misses += 1
+            return None
+        self._data[key] = rv    # mark as most recently used
+        self.hits += 1
+        return rv
+
+    def put(self, key, rv):
+        if len(rv) > self.max_chars:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.chars -= len(old)
+        self._data[key] = rv
+        self.chars += len(rv)
+        while len(self._data) > self.maxsize or self.chars > self.max_chars:
+            key, old = self._data.popitem(last=False)
+            self.chars -= len(old)
+            self.evictions += 1
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, size=len(self._data),
+                    maxsize=self.maxsize, chars=self.chars,
+                    max_chars=self.max_chars)
+
+_render_cache = None
+
+def enable_render_cache(maxsize=256, max_chars=8*1024*1024):
+    """Cache conversion results in this process (opt-in).
+
+    Results (including "toc_html" and "metadata") are shared between
+    callers converting the same text with the same options, so they
+    should be treated as read-only.
+    """
+    global _render_cache
+    _render_cache = _RenderCache(maxsize, max_chars)
+
+def disable_render_cache():
+    global _render_cache
+    _render_cache = None
+
+def render_cache_info():
+    """Return hit/miss/eviction counters of the render cache, or None if
+    it is not enabled.
+    """
+    if _render_cache is None:
+        return None
+    return _render_cache.info()
+
+
 #---- internal support functions
 
 class UnicodeWithAttrs(unicode):
@@ -31,7 +31,12 @@ class Blog(Model):
     name = StringField(name='name', ddl='varchar(50)')
     summary = StringField(name='summary', ddl='varchar(200)')
     content = TextField(name='content')
+    # 预先渲染好的正文html,以及渲染时使用的渲染器版本(见render.py)
+    html_content = TextField(name='html_content')
+    html_version = StringField(name='html_version', ddl='varchar(50)')
     created_at = FloatField(name='created_at', default=time.time)
+    # 最后修改时间,用于Last-Modified/ETag
+    updated_at = FloatField(name='updated_at', default=time.time)
     #主键id的缺省值是函数next_id，创建时间created_at的缺省值是函数time.time，可以自动设置当前日期和时间。
 
 class Comment(Model):
@@ -1,17 +1,250 @@
-import logging, asyncio
+import logging, asyncio, time, contextvars, collections, weakref
+from contextlib import asynccontextmanager, aclosing
 
 import aiomysql     #aiomysql为MySQL数据库提供了异步IO的驱动。
 
+# 当前请求中每种SQL语句(带?占位符的语句)执行的次数,由start_query_stats()开启,用于发现N+1查询
+_query_stats = contextvars.ContextVar('query_stats', default=None)
+
+# 在当前上下文(一个请求)中开始统计SQL语句的执行次数,返回统计用的字典
+def start_query_stats():
+    stats = {}
+    _query_stats.set(stats)
+    return stats
+
 #该函数用于打印执行的SQL语句
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    logging.debug('SQL: %s', sql)
+    stats = _query_stats.get()
+    if stats is not None:
+        stats[sql] = stats.get(sql, 0) + 1
 
-#每个HTTP请求都可以从连接池中直接获取数据库连接。使用连接池的好处是不必频繁地打开和关闭数据库连接，而是能复用就尽量复用。
-#该函数用于创建连接池
-async def create_pool(loop, **kw):
-    logging.info('create database connection pool...')
-    global __pool     #全局变量用于保存连接池
-    __pool = await aiomysql.create_pool(    #dict提供的get方法，如果key不存在，可以返回None，或者自己指定的value
+__pool = None
+# 只读副本的连接池,select优先发往副本,写操作只发往主库(__pool)
+_replicas = []
+# 暂时不可用的副本: 连接池 -> 恢复尝试的时间
+_replica_down = {}
+_read_options = dict(strategy='round_robin', read_your_writes=1, retry_interval=5)
+_read_counter = [0]
+# 当前上下文(一个请求)中最后一次写操作的时间,之后read_your_writes秒内的读操作发往主库,保证读到自己写入的数据
+_last_write = contextvars.ContextVar('last_write', default=0)
+
+# 副本连接失败时的错误,发生时改用主库重试.OperationalError也用于死锁、锁等待超时等查询本身的错误,
+# 只有连不上(2003)、连接断开(2006, 2013)才算副本不可用
+_REPLICA_ERRORS = (aiomysql.OperationalError, aiomysql.InterfaceError, OSError, asyncio.TimeoutError)
+_CONNECTION_ERRNOS = (2003, 2006, 2013)
+
+def _is_connection_error(e):
+    if isinstance(e, aiomysql.OperationalError):
+        return bool(e.args) and e.args[0] in _CONNECTION_ERRNOS
+    return True
+
+# =============================连接池统计==========================
+class PoolStats(object):
+    '''
+    Metrics of one connection pool: checkout wait histogram, timeouts and connection churn.
+    '''
+    # 等待时间直方图的上限(毫秒),最后一个桶为超过1秒的
+    BUCKETS = (1, 5, 10, 50, 100, 500, 1000)
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.timeouts = 0
+        self.opened = 0
+        self.recycled = 0
+        # 见过的连接,连接被连接池关闭后会被回收
+        self._conns = weakref.WeakSet()
+        # 自适应调整时使用的窗口统计
+        self.window_checkouts = 0
+        self.window_wait = 0.0
+        self.window_peak = 0
+
+    def record(self, wait, conn):
+        self.checkouts += 1
+        self.wait_total += wait
+        ms = wait * 1000
+        i = 0
+        while i < len(self.BUCKETS) and ms > self.BUCKETS[i]:
+            i += 1
+        self.histogram[i] += 1
+        self.track(conn)
+        self.window_checkouts += 1
+        self.window_wait += wait
+        self.window_peak = max(self.window_peak, self.in_use)
+
+    def track(self, conn):
+        if conn not in self._conns:
+            self._conns.add(conn)
+            self.opened += 1
+
+    def reset_window(self):
+        self.window_checkouts = 0
+        self.window_wait = 0.0
+        self.window_peak = self.in_use
+
+    @property
+    def in_use(self):
+        return self.pool.size - self.pool.freesize
+
+    def as_dict(self):
+        labels = ['<=%sms' % b for b in self.BUCKETS] + ['>%sms' % self.BUCKETS[-1]]
+        return dict(
+            name = self.name,
+            minsize = self.pool.minsize,
+            maxsize = self.pool.maxsize,
+            size = self.pool.size,
+            in_use = self.in_use,
+            free = self.pool.freesize,
+            checkouts = self.checkouts,
+            wait_avg_ms = self.wait_total * 1000 / self.checkouts if self.checkouts else 0,
+            wait_histogram = dict(zip(labels, self.histogram)),
+            timeouts = self.timeouts,
+            opened = self.opened,
+            closed = self.opened - len(self._conns),
+            recycled = self.recycled
+        )
+
+# 连接池 -> PoolStats
+_pool_stats = {}
+# 从连接池获取连接的超时时间(秒),0表示一直等待
+_acquire_timeout = [0]
+
+# 从连接池获取连接,记录等待的时间,超时抛出asyncio.TimeoutError
+@asynccontextmanager
+async def _acquire(pool):
+    stats = _pool_stats.get(pool)
+    start = time.perf_counter()
+    if _acquire_timeout[0] > 0:
+        try:
+            conn = await asyncio.wait_for(pool.acquire(), _acquire_timeout[0])
+        except asyncio.TimeoutError:
+            if stats is not None:
+                stats.timeouts += 1
+            logging.warning('timeout acquiring a connection from pool %s.', stats.name if stats else pool)
+            raise
+    else:
+        conn = await pool.acquire()
+    if stats is not None:
+        stats.record(time.perf_counter() - start, conn)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+# 所有连接池的统计信息
+def pool_stats():
+    return [stats.as_dict() for stats in _pool_stats.values()]
+
+# 调整连接池的最大连接数.aiomysql的最大连接数就是空闲连接队列的maxlen,只能换一个队列.
+# 缩小时只关闭多出来的空闲连接;使用中的连接归还时会放回空闲队列,队列满了会把最早的连接挤出去而不关闭,
+# 所以maxlen不能小于当前的连接数,剩下的等以后再缩小
+def _resize_pool(pool, maxsize):
+    while pool._free and pool.size > maxsize:
+        pool._free.popleft().close()
+    pool._free = collections.deque(pool._free, maxlen=max(maxsize, pool.size))
+
+# 根据最近一段时间的等待情况调整连接池的大小: 平均等待超过grow_wait秒时增加,
+# 使用中的连接数的峰值远小于最大连接数时减少,始终在[minsize, max_size]之间
+async def _adapt_pools(interval, max_size, grow_wait, step=2):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await _adapt_pools_once(max_size, grow_wait, step)
+        except Exception as e:
+            logging.exception(e)
+
+async def _adapt_pools_once(max_size, grow_wait, step):
+    for pool, stats in list(_pool_stats.items()):
+        maxsize = pool.maxsize
+        if stats.window_checkouts and stats.window_wait / stats.window_checkouts > grow_wait and maxsize < max_size:
+            maxsize = min(max_size, maxsize + step)
+        elif stats.window_peak + step < maxsize and maxsize > pool.minsize:
+            maxsize = max(pool.minsize, maxsize - 1)
+        if maxsize != pool.maxsize:
+            logging.info('resize pool %s: %s => %s', stats.name, pool.maxsize, maxsize)
+            _resize_pool(pool, maxsize)
+            # 增大后等待连接的请求可以建立新连接了
+            await _wakeup(pool)
+        stats.reset_window()
+
+_adapt_task = None
+
+# =============================预热和健康检查==========================
+# 唤醒在acquire()中等待的请求.直接修改了连接池的队列后,连接池自己不会通知它们
+async def _wakeup(pool):
+    async with pool._cond:
+        pool._cond.notify_all()
+
+# 并发地建立连接,直到连接池中有n个连接(不超过最大连接数).aiomysql在锁内逐个建立连接,所以这里直接放入空闲队列
+async def _warm_pool(pool, n):
+    n = min(n, pool.maxsize) - pool.size
+    if n <= 0:
+        return
+    loop = asyncio.get_event_loop()
+    results = await asyncio.gather(*[aiomysql.connect(echo=pool.echo, loop=loop, **pool._conn_kwargs) for i in range(n)], return_exceptions=True)
+    stats = _pool_stats.get(pool)
+    for conn in results:
+        if isinstance(conn, BaseException):
+            logging.warning('failed to open connection for pool %s: %s', stats.name if stats else pool, conn)
+        elif pool.size < pool.maxsize and not pool._closing:
+            pool._free.append(conn)
+            if stats is not None:
+                stats.track(conn)
+        else:
+            conn.close()
+    await _wakeup(pool)
+
+# ping一个空闲的连接,失败的关闭,由连接池丢弃
+async def _ping(pool, conn, timeout):
+    try:
+        await asyncio.wait_for(conn.ping(reconnect=False), timeout)
+        return True
+    except Exception as e:
+        conn.close()
+        stats = _pool_stats.get(pool)
+        if stats is not None:
+            stats.recycled += 1
+        logging.warning('recycle dead connection of pool %s: %s', stats.name if stats else pool, e)
+        return False
+    finally:
+        # 像普通的连接一样归还;关闭的连接归还时连接池不会唤醒等待的请求,由_check_pools统一唤醒
+        await pool.release(conn)
+
+# 定期检查空闲超过idle秒的连接,坏掉的连接(比如MySQL重启后)在请求使用之前关闭,并补充到warmup个连接
+async def _check_pools(interval, idle, warmup, timeout=5):
+    while True:
+        await asyncio.sleep(interval)
+        # 一次检查出错不能让后台检查停止
+        try:
+            await _check_pools_once(idle, warmup, timeout)
+        except Exception as e:
+            logging.exception(e)
+
+async def _check_pools_once(idle, warmup, timeout):
+    now = asyncio.get_event_loop().time()
+    for pool in list(_pool_stats.keys()):
+        if pool._closing:
+            continue
+        idle_conns = [conn for conn in pool._free if now - conn.last_usage > idle]
+        for conn in idle_conns:
+            # 检查期间从空闲队列中取出,不会被请求使用
+            pool._free.remove(conn)
+            pool._used.add(conn)
+        await asyncio.gather(*[_ping(pool, conn, timeout) for conn in idle_conns])
+        # 有连接被关闭时,等待的请求可以建立新连接了
+        await _wakeup(pool)
+        if pool in _replica_down and _replica_down[pool] > time.time():
+            continue
+        await _warm_pool(pool, warmup)
+
+_check_task = None
+
+async def _create_pool(loop, **kw):
+    return await aiomysql.create_pool(    #dict提供的get方法，如果key不存在，可以返回None，或者自己指定的value
         host=kw.get('host', 'localhost'),   # 默认定义host名字为localhost
         port=kw.get('port', 3306),          # 默认定义mysql的默认端口是3306
         user=kw['user'],                    # user是通过关键字参数传进来的
@@ -24,36 +257,188 @@ async def create_pool(loop, **kw):
         loop=loop                           # 传递消息循环对象loop用于异步执行
     )
 
+#每个HTTP请求都可以从连接池中直接获取数据库连接。使用连接池的好处是不必频繁地打开和关闭数据库连接，而是能复用就尽量复用。
+#该函数用于创建连接池
+# replicas是只读副本的配置列表,每一项覆盖主库的配置(通常只有host/port),
+# read_strategy为round_robin(轮流)或least_busy(使用中的连接最少的副本)
+# acquire_timeout为获取连接的超时时间,adaptive为True时每adaptive_interval秒根据等待时间在[minsize, adaptive_max]之间调整最大连接数
+# 创建后每个连接池预先建立warmup个连接;每ping_interval秒ping空闲超过idle_ping秒的连接,关闭坏掉的连接并补充
+async def create_pool(loop, replicas=(), read_strategy='round_robin', read_your_writes=1, replica_retry=5,
+        acquire_timeout=0, adaptive=False, adaptive_max=30, adaptive_interval=10, adaptive_wait=0.01,
+        warmup=0, ping_interval=0, idle_ping=60, **kw):
+    logging.info('create database connection pool...')
+    global __pool, _adapt_task, _check_task     #全局变量用于保存连接池
+    __pool = await _create_pool(loop, **kw)
+    _pool_stats[__pool] = PoolStats('primary', __pool)
+    _acquire_timeout[0] = acquire_timeout
+    _read_options.update(strategy=read_strategy, read_your_writes=read_your_writes, retry_interval=replica_retry)
+    for r in replicas:
+        options = dict(kw, **r)
+        logging.info('create replica connection pool %s:%s...', options.get('host', 'localhost'), options.get('port', 3306))
+        try:
+            pool = await _create_pool(loop, **options)
+        except _REPLICA_ERRORS as e:
+            if not _is_connection_error(e):
+                raise
+            # 副本启动时不可用,先不建立连接,稍后再试
+            logging.warning('replica %s:%s is down: %s', options.get('host', 'localhost'), options.get('port', 3306), e)
+            pool = await _create_pool(loop, **dict(options, minsize=0))
+            _replica_down[pool] = time.time() + _read_options['retry_interval']
+        _pool_stats[pool] = PoolStats('replica%s' % len(_replicas), pool)
+        _replicas.append(pool)
+    if warmup > 0:
+        await asyncio.gather(*[_warm_pool(pool, warmup) for pool in _pool_stats if pool not in _replica_down])
+        logging.info('warmed up %s connections.', sum(pool.size for pool in _pool_stats))
+    if adaptive:
+        _adapt_task = asyncio.ensure_future(_adapt_pools(adaptive_interval, adaptive_max, adaptive_wait))
+    if ping_interval > 0:
+        _check_task = asyncio.ensure_future(_check_pools(ping_interval, idle_ping, warmup))
+
+# 关闭连接池,等待所有连接释放
+async def close_pool():
+    global __pool, _adapt_task, _check_task
+    for task in (_adapt_task, _check_task):
+        if task is not None:
+            task.cancel()
+    _adapt_task = _check_task = None
+    pools = _replicas[:]
+    if __pool is not None:
+        pools.append(__pool)
+    for pool in pools:
+        pool.close()
+        await pool.wait_closed()
+    __pool = None
+    _replicas.clear()
+    _replica_down.clear()
+    _pool_stats.clear()
+
+# 选择读操作使用的连接池: 没有可用的副本,或者当前请求刚写过数据时使用主库
+def _read_pool():
+    if not _replicas or time.time() - _last_write.get() < _read_options['read_your_writes']:
+        return __pool
+    now = time.time()
+    alive = [pool for pool in _replicas if _replica_down.get(pool, 0) <= now]
+    if not alive:
+        return __pool
+    _read_counter[0] += 1
+    if _read_options['strategy'] == 'least_busy':
+        # 使用中的连接最少的副本,相同时轮流
+        n = _read_counter[0]
+        return min(alive[n % len(alive):] + alive[:n % len(alive)], key=lambda pool: pool.size - pool.freesize)
+    return alive[_read_counter[0] % len(alive)]
+
+def _replica_failed(pool, e):
+    logging.warning('replica query failed, retry on primary: %s', e)
+    _replica_down[pool] = time.time() + _read_options['retry_interval']
+
+def _wrote():
+    if _replicas:
+        _last_write.set(time.time())
+
 # =============================SQL处理函数区==========================
 # select语句则对应该select方法,传入sql语句和参数
 async def select(sql, args, size=None):
     log(sql, args)
-    # 这里声明global,是为了区分赋值给同名的局部变量(这里其实可以省略，因为后面没赋值)
-    global __pool
+    tx = _transaction.get()
+    if tx is not None:
+        async with tx.lock:
+            return (await _fetch(tx.conn, sql, args, size))
+    pool = _read_pool()
+    try:
+        return (await _select(pool, sql, args, size))
+    except _REPLICA_ERRORS as e:
+        if pool is __pool or not _is_connection_error(e):
+            raise
+        _replica_failed(pool, e)
+        return (await _select(__pool, sql, args, size))
+
+# 只从主库读取,用于不能读到副本上延迟数据的场合,比如填充find缓存
+async def _select_primary(sql, args, size=None):
+    log(sql, args)
+    return (await _select(__pool, sql, args, size))
+
+async def _select(pool, sql, args, size):
     # 异步等待连接池对象返回可以连接线程，with语句则封装了清理（关闭conn）和处理异常的工作
-    async with __pool.get() as conn:
-        # 等待连接对象返回DictCursor可以通过dict的方式获取数据库对象，需要通过游标对象执行SQL
-        # 默认情况下cursor方法返回的是BaseCursor类型对象，BaseCursor类型对象在执行查询后每条记录的结果以列表(list)表示,DictCursor(字典)
-        #建立游标
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            # 所有args都通过repalce方法把占位符替换成%s
-            #查询
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            if size:
-                #获取结果集
-                rs = await cur.fetchmany(size)  # 从数据库获取指定的行数,返回结果是一个元组,tuple中的每一个元素对应查询结果中的一条记录
-            else:
-                rs = await cur.fetchall()       # 返回所有结果集,返回结果是一个元组
-        logging.info('rows returned: %s' % len(rs))
-        return rs          # 返回结果集
+    async with _acquire(pool) as conn:
+        return (await _fetch(conn, sql, args, size))
+
+async def _fetch(conn, sql, args, size):
+    # 等待连接对象返回DictCursor可以通过dict的方式获取数据库对象，需要通过游标对象执行SQL
+    # 默认情况下cursor方法返回的是BaseCursor类型对象，BaseCursor类型对象在执行查询后每条记录的结果以列表(list)表示,DictCursor(字典)
+    #建立游标
+    async with conn.cursor(aiomysql.DictCursor) as cur:
+        # 所有args都通过repalce方法把占位符替换成%s
+        #查询
+        await cur.execute(sql.replace('?', '%s'), args or ())
+        if size:
+            #获取结果集
+            rs = await cur.fetchmany(size)  # 从数据库获取指定的行数,返回结果是一个元组,tuple中的每一个元素对应查询结果中的一条记录
+        else:
+            rs = await cur.fetchall()       # 返回所有结果集,返回结果是一个元组
+    logging.debug('rows returned: %s', len(rs))
+    return rs          # 返回结果集
+
+# 使用无缓冲的服务器端游标(SSDictCursor)逐批读取结果集,每次只在内存中保留batch行,是一个异步生成器
+# 事务中一次读出全部结果再逐批返回,因为无缓冲的游标读完之前,事务的连接不能执行其他语句
+# 没有读完就break时,生成器要到被回收时才关闭游标、释放连接,所以应该这样使用:
+#     async with aclosing(select_iter(sql, args)) as it:
+#         async for rs in it: ...
+async def select_iter(sql, args, batch=500):
+    log(sql, args)
+    tx = _transaction.get()
+    if tx is not None:
+        async with tx.lock:
+            rs = await _fetch(tx.conn, sql, args, None)
+        for i in range(0, len(rs), batch):
+            yield rs[i:i+batch]
+        return
+    pool = _read_pool()
+    started = False
+    try:
+        async with aclosing(_select_iter(pool, sql, args, batch)) as it:
+            async for rs in it:
+                started = True
+                yield rs
+    except _REPLICA_ERRORS as e:
+        # 已经返回过部分结果的不能重试
+        if pool is __pool or started or not _is_connection_error(e):
+            raise
+        _replica_failed(pool, e)
+        async with aclosing(_select_iter(__pool, sql, args, batch)) as it:
+            async for rs in it:
+                yield rs
+
+# 外层生成器被关闭时,async for不会关闭内层的生成器,每一层都用aclosing
+async def _select_iter(pool, sql, args, batch):
+    async with _acquire(pool) as conn:
+        async with aclosing(_fetch_iter(conn, sql, args, batch)) as it:
+            async for rs in it:
+                yield rs
+
+async def _fetch_iter(conn, sql, args, batch):
+    async with conn.cursor(aiomysql.SSDictCursor) as cur:
+        await cur.execute(sql.replace('?', '%s'), args or ())
+        while True:
+            rs = await cur.fetchmany(batch)
+            if not rs:
+                break
+            yield rs
 
 #SQL语句的占位符是?，而MySQL的占位符是%s，select()函数在内部自动替换。
 #yield from将调用一个子协程（也就是在一个协程中调用另一个协程）并直接获得子协程的返回结果。
 
 # execute方法只返回结果数，不返回结果集,用于insert,update,delete这些SQL语句.这3种SQL的执行都需要相同的参数，以及返回一个整数表示影响的行数
+# 在transaction()中时使用事务的连接,由事务统一提交,autocommit参数不起作用
 async def execute(sql, args, autocommit=True):
     log(sql)
-    async with __pool.get() as conn:
+    _wrote()
+    tx = _transaction.get()
+    if tx is not None:
+        async with tx.lock:
+            async with tx.conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(sql.replace('?', '%s'), args)
+                return cur.rowcount
+    async with _acquire(__pool) as conn:
         if not autocommit:
             await conn.begin()
         try:
@@ -70,6 +455,180 @@ async def execute(sql, args, autocommit=True):
         return affected
 #返回一个整数表示影响的行数
 
+# 在同一个连接、同一个事务中依次执行多条(sql, args)语句,只占用一次连接池,返回受影响的总行数.用于批量写入
+async def execute_many(stmts):
+    async with transaction() as tx:
+        affected = 0
+        async with tx.lock:
+            async with tx.conn.cursor(aiomysql.DictCursor) as cur:
+                for sql, args in stmts:
+                    log(sql)
+                    await cur.execute(sql.replace('?', '%s'), args)
+                    affected += cur.rowcount
+        return affected
+
+# =============================事务==========================
+# 当前上下文中的事务,transaction()中的select/execute都使用事务的连接
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+class Transaction(object):
+    '''
+    A transaction pinned to one connection, use orm.transaction() to create it.
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        # 同一个事务中并发的语句(比如asyncio.gather)在一个连接上依次执行
+        self.lock = asyncio.Lock()
+        self.savepoints = 0
+        # 提交后才执行的回调协程(更新count缓存、清除find缓存、通知监听者),回滚时丢弃
+        self.on_commit = []
+
+    async def _execute(self, sql):
+        log(sql)
+        async with self.lock:
+            async with self.conn.cursor() as cur:
+                await cur.execute(sql)
+
+# 用法:
+#     async with orm.transaction():
+#         await comment.save()
+#         await blog.update()
+# 其中的Model.save/update/remove/find等使用同一个连接,结束时提交一次,出错时回滚.
+# 嵌套的transaction()使用保存点(savepoint),出错时只回滚到保存点
+@asynccontextmanager
+async def transaction():
+    tx = _transaction.get()
+    if tx is not None:
+        tx.savepoints += 1
+        name = 'sp%s' % tx.savepoints
+        pending = len(tx.on_commit)
+        await tx._execute('SAVEPOINT %s' % name)
+        try:
+            yield tx
+        except BaseException:
+            await tx._execute('ROLLBACK TO SAVEPOINT %s' % name)
+            del tx.on_commit[pending:]
+            raise
+        await tx._execute('RELEASE SAVEPOINT %s' % name)
+        return
+    _wrote()
+    async with _acquire(__pool) as conn:
+        await conn.begin()
+        tx = Transaction(conn)
+        token = _transaction.set(tx)
+        try:
+            yield tx
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+        finally:
+            _transaction.reset(token)
+    for callback in tx.on_commit:
+        await callback()
+
+# 写入之后更新count缓存、清除find缓存并通知监听者;事务中的写入在提交之后才生效,所以推迟到提交之后
+async def _changed(table, delta, op, objs):
+    async def callback():
+        _update_counts(table, delta, objs[0].__primary_key__)
+        for obj in objs:
+            await _invalidate_find(table, obj.get(obj.__primary_key__))
+            _notify(table, op, obj)
+    tx = _transaction.get()
+    if tx is not None:
+        tx.on_commit.append(callback)
+    else:
+        await callback()
+
+
+# =============================count缓存==========================
+# findNumber的结果按表缓存在内存中: {表名: {(selectField, where, args): [值, 过期时间]}}
+# 写操作会按影响的行数修正不带where的count,该表其余的缓存条目直接失效,TTL用于兜底(比如其他进程的写入)
+_count_cache = {}
+_count_ttl = 60
+# 每个表的写入次数,查询count期间表被修改过时,查询的结果不放入缓存
+_count_generation = collections.Counter()
+
+# 设置count缓存的有效期(秒),小于等于0表示关闭缓存
+def set_count_ttl(ttl):
+    global _count_ttl
+    _count_ttl = ttl
+    _count_cache.clear()
+
+def _get_count(table, key):
+    # 事务中可能有未提交的写入,不使用缓存
+    if _transaction.get() is not None:
+        return None
+    entry = _count_cache.get(table, {}).get(key)
+    if entry is None or entry[1] < time.time():
+        return None
+    return entry[0]
+
+def _put_count(table, key, value, generation):
+    if _count_ttl > 0 and value is not None and _transaction.get() is None and _count_generation[table] == generation:
+        _count_cache.setdefault(table, {})[key] = [value, time.time() + _count_ttl]
+
+# 表中的行数变化了delta行(插入为正,删除为负,更新为0).
+# 只有count(*)和count(主键)等于行数,可以直接修正;count(distinct ...)、可能为NULL的列等条目直接失效
+def _update_counts(table, delta, pk):
+    _count_generation[table] += 1
+    entries = _count_cache.get(table)
+    if not entries:
+        return
+    exact = ('count(*)', 'count(%s)' % pk.lower())
+    for key in list(entries.keys()):
+        selectField, where, args = key
+        if delta and where is None and selectField.lower().replace(' ', '').replace('`', '') in exact:
+            entries[key][0] += delta
+        else:
+            del entries[key]
+
+# =============================find缓存==========================
+# Model.find(pk)的结果按(表名, 主键)缓存,后端见cache.LocalCache/SocketCache.缓存的是数据库的一行,
+# 空dict表示记录不存在(负缓存,有效期较短).save/update/remove后自动清除,事务中不使用缓存
+_find_cache = None
+_find_options = dict(ttl=60, negative_ttl=5)
+
+# 设置find缓存的后端,None表示不缓存
+def set_find_cache(backend, ttl=60, negative_ttl=5):
+    global _find_cache
+    if _find_cache is not None:
+        _find_cache.close()
+    _find_cache = backend
+    _find_options.update(ttl=ttl, negative_ttl=negative_ttl)
+
+async def _invalidate_find(table, pk):
+    if _find_cache is not None:
+        await _find_cache.delete('%s:%s' % (table, pk))
+
+# find缓存的命中率等统计信息
+def find_cache_stats():
+    if _find_cache is None:
+        return None
+    return dict(_find_cache.stats(), ttl=_find_options['ttl'], negative_ttl=_find_options['negative_ttl'])
+
+# =============================写操作监听==========================
+# 表名 -> 回调函数列表. Model写入数据库后调用callback(op, model),op为'insert','update'或'delete'
+# 用于让会话缓存等在记录变化时失效
+_listeners = {}
+
+def on_change(table, callback):
+    _listeners.setdefault(table, []).append(callback)
+
+def _notify(table, op, obj):
+    for callback in _listeners.get(table, ()):
+        try:
+            callback(op, obj)
+        except Exception as e:
+            logging.exception(e)
+
+# 参数在SQL语句中大约占用的字节数,字符串按utf-8计算并预留转义的空间
+def _arg_size(value):
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) * 2 + 3
+    if isinstance(value, bytes):
+        return len(value) * 2 + 3
+    return 24
 
 #ORM全称“Object Relational Mapping”，即对象-关系映射，就是把关系数据库的一行映射为一个对象，也就是一个类对应一个表，这样，写代码更简单，不用直接操作SQL语句。
 # =====================================属性类===============================
@@ -110,6 +669,41 @@ class TextField(Field):
     def __init__(self, name=None, default=None):
         super().__init__(name, 'text', False, default)
 
+# 已知字段的属性访问器.元类为__mappings__中的每个字段在类上安装一个,
+# 使blog.name直接取self['name'],不必先查找失败再进入Model.__getattr__的try/except
+class FieldAccessor(object):
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        try:
+            return obj[self.key]
+        except KeyError:
+            # 抛出AttributeError后Python会再调用Model.__getattr__,由它给出具体的错误信息
+            raise AttributeError(self.key)
+
+# 为每个Model子类生成专用的from_row(row): 直接用dict.update填充数据库返回的行,省去cls(**r)的关键字参数解包和__init__调用
+# deferred为查询时没有取出的字段,记录在对象上
+def make_from_row(cls, deferred=()):
+    new = dict.__new__
+    update = dict.update
+    if deferred:
+        def from_row(row):
+            obj = new(cls)
+            update(obj, row)
+            obj.__dict__['_deferred'] = deferred
+            return obj
+    else:
+        def from_row(row):
+            obj = new(cls)
+            update(obj, row)
+            return obj
+    return from_row
+
 # ========================================Model基类以及其元类=====================
 # 对象和关系之间要映射起来，首先考虑创建所有Model类的一个父类，具体的Model对象（就是数据库表在你代码中对应的对象）再继承这个基类
 # 该元类主要使得Model基类具备以下功能:
@@ -134,16 +728,16 @@ class ModelMetaclass(type):
             return type.__new__(cls, name, bases, attrs)
         # 获取table名称:
         tableName = attrs.get('__table__', None) or name      # 前面get失败了就直接赋值name.  __table__属性在models.py的每个类中有定义。
-        logging.info('found model: %s (table: %s)' % (name, tableName))
+        logging.info('found model: %s (table: %s)', name, tableName)
         # 获取所有的Field和主键名:
         mappings = dict()   # 创建空字典，用于保存属性和值的k,v
         fields = []
         primaryKey = None
         for k, v in attrs.items():
             # 用于测试：观察类属性的字典,比如输出INFO:root: attrs : name ==> <StringField, varchar(50):None>，v的值对应Field中的__str__方法。
-            logging.info(' attrs : %s ==> %s' % (k, v))
+            logging.info(' attrs : %s ==> %s', k, v)
             if isinstance(v, Field):
-                logging.info(' found mapping: %s ==> %s' % (k, v))
+                logging.info(' found mapping: %s ==> %s', k, v)
                 mappings[k] = v
                 if v.primary_key:      #为什么是v.primary_key?  v的类型?  attrs类型？ 原因：v是Field子类的实例对象，存在primary_key属性。
                     # 找到主键:
@@ -154,8 +748,10 @@ class ModelMetaclass(type):
                     fields.append(k)   # 非主键全部放到fields列表中
         if not primaryKey:      # 如果遍历完还没找到主键，那抛出错误
             raise RuntimeError('Primary key not found.')
-        for k in mappings.keys():     # 清除attrs中mappings存在的属性
+        for k in mappings.keys():     # 清除attrs中mappings存在的属性,换成属性访问器(与父类的方法同名的字段除外)
             attrs.pop(k)
+            if not any(hasattr(b, k) for b in bases):
+                attrs[k] = FieldAccessor(k)
         # %s占位符全部替换成具体的属性名
         # 通常情况不需要` ，但是遇到字段名字和sql关键字同名时就需要了
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
@@ -175,14 +771,18 @@ class ModelMetaclass(type):
         # mappings.get(f).name == None,这跟User、Blog、Comment类的属性初始化是否设置name参数有关,Field的子类中name参数均初始化为None，所以mappings.get(f).name or f 等同于 f
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+        # 按字段集合缓存的部分字段SELECT语句,见Model._projection
+        attrs['__projections__'] = {}
 
         # 用于测试:查看默认的sql语句
-        logging.info(' select: %s ' % attrs.get('__select__',None))
-        logging.info(' insert: %s ' % attrs.get('__insert__',None))
-        logging.info(' update: %s ' % attrs.get('__update__',None))
-        logging.info(' delete: %s ' % attrs.get('__delete__',None))
+        logging.info(' select: %s ', attrs.get('__select__',None))
+        logging.info(' insert: %s ', attrs.get('__insert__',None))
+        logging.info(' update: %s ', attrs.get('__update__',None))
+        logging.info(' delete: %s ', attrs.get('__delete__',None))
 
-        return type.__new__(cls, name, bases, attrs)
+        model = type.__new__(cls, name, bases, attrs)
+        model.from_row = staticmethod(make_from_row(model))
+        return model
 
 #所有ORM映射的基类Model
 #任何继承自Model的类，会自动通过ModelMetaclass扫描映射关系，并存储到自身的类属性如__table__、__mappings__中
@@ -197,6 +797,8 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in self.__dict__.get('_deferred', ()):
+                raise AttributeError(r"field '%s' was deferred, use load_deferred() to load it" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
@@ -214,23 +816,55 @@ class Model(dict, metaclass=ModelMetaclass):
             if field.default is not None:  # 如果实例的域存在默认值，则使用默认值
                 # field.default是callable的话则直接调用
                 value = field.default() if callable(field.default) else field.default  ######
-                logging.debug('using default value for %s: %s' % (key, str(value)))
+                logging.debug('using default value for %s: %s', key, value)
                 setattr(self, key, value)
         return value
 
 
     # --------------------------每个Model类的子类实例应该具备的执行SQL的方法------
-    @classmethod    #类方法
-    async def findAll(cls, where=None, args=None, **kw):
-        '查询匹配的所有结果集'
-        # 拼接select的sql语句
-        sql = [cls.__select__]
+    @classmethod
+    def _projection(cls, fields=None, defer=None):
+        # 只查询部分字段: fields为要取出的字段,defer为不取出的字段,主键总是取出
+        # 返回(select语句, from_row),按字段集合缓存,每种组合只拼接一次
+        if not fields and not defer:
+            return cls.__select__, cls.from_row
+        key = (tuple(fields or ()), tuple(defer or ()))
+        projection = cls.__projections__.get(key)
+        if projection is None:
+            for f in tuple(fields or ()) + tuple(defer or ()):
+                if f not in cls.__mappings__:
+                    raise ValueError('Invalid field: %s' % f)
+            selected = [f for f in cls.__fields__ if (not fields or f in fields) and (not defer or f not in defer)]
+            deferred = frozenset(f for f in cls.__fields__ if f not in selected)
+            sql = 'select `%s`%s from `%s`' % (cls.__primary_key__, ''.join(map(lambda f: ', `%s`' % f, selected)), cls.__table__)
+            projection = cls.__projections__[key] = (sql, make_from_row(cls, deferred))
+        return projection
+
+    @classmethod
+    def _select_sql(cls, where=None, args=None, **kw):
+        # 拼接select的sql语句,返回(sql, args, from_row),供findAll和iter_all共用
+        args = [] if args is None else list(args)
+        select_sql, from_row = cls._projection(kw.get('fields', None), kw.get('defer', None))
+        orderBy = kw.get('orderBy', None)
+        # 键集(seek)分页: after/before传入上一页最后一条/第一条记录在keys上的值,默认keys为(created_at, 主键)
+        # after生成 where (`created_at`, `id`) < (?, ?),before生成 >,避免offset分页扫描并丢弃前面的行
+        after = kw.get('after', None)
+        before = kw.get('before', None)
+        seek = after if after is not None else before
+        if seek is not None:
+            keys = kw.get('keys', None) or ('created_at', cls.__primary_key__)
+            if len(seek) != len(keys):
+                raise ValueError('Invalid seek value: %s' % str(seek))
+            cond = '(%s) %s (%s)' % (', '.join(map(lambda k: '`%s`' % k, keys)), '<' if after is not None else '>', create_args_string(len(keys)))
+            where = '(%s) and %s' % (where, cond) if where else cond
+            args.extend(seek)
+            if not orderBy:
+                # before按升序取出紧邻的记录,findAll再反转成降序
+                orderBy = ', '.join(map(lambda k: '`%s` %s' % (k, 'desc' if after is not None else 'asc'), keys))
+        sql = [select_sql]
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
@@ -245,55 +879,144 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        # 用于测试:查看select结果集
-        for r in rs:
-            logging.info('findAll rs: %s' % r)
-            logging.info('findAll rs_cls: %s' % cls(**r))
-        # INFO:root:findAll rs: {'id': '001482808658778b514127d15b0467d8470dd35939c5cd9000',
-        #                        'user_id': '0014794846276707349fe7cddc34b849f86e59a8cdb5e50000',
-        #                        'user_name': 'zhangeli',
-        #                        'user_image': 'http://www.gravatar.com/avatar/f312905fee0764595a7d940a57531dfb?d=mm&s=120',
-        #                        'name': '56',
-        #                        'summary': '5556',
-        #                        'content': '55556',
-        #                        'created_at': 1482808658.77836}
+        return ' '.join(sql), args, from_row
 
-        # INFO:root:findAll rs_cls: {'id': '001482808658778b514127d15b0467d8470dd35939c5cd9000',
+    @classmethod    #类方法
+    async def findAll(cls, where=None, args=None, **kw):
+        '查询匹配的所有结果集'
+        sql, args, from_row = cls._select_sql(where, args, **kw)
+        rs = await select(sql, args)
+        if kw.get('before', None) is not None and not kw.get('orderBy', None):
+            rs = rs[::-1]
+        # 用于测试:查看select结果集(只在DEBUG级别时格式化)
+        logging.debug('findAll rs: %s', rs)
+        # DEBUG:root:findAll rs: [{'id': '001482808658778b514127d15b0467d8470dd35939c5cd9000',
         #                        'user_id': '0014794846276707349fe7cddc34b849f86e59a8cdb5e50000',
         #                        'user_name': 'zhangeli',
         #                        'user_image': 'http://www.gravatar.com/avatar/f312905fee0764595a7d940a57531dfb?d=mm&s=120',
         #                        'name': '56',
         #                        'summary': '5556',
         #                        'content': '55556',
-        #                        'created_at': 1482808658.77836}
+        #                        'created_at': 1482808658.77836}, ...]
 
         # select()的返回结果rs是一个元组
-        return [cls(**r) for r in rs]    #findAll返回列表
+        return [from_row(r) for r in rs]    #findAll返回列表
+
+    @classmethod    # 类方法
+    async def iter_all(cls, where=None, args=None, batch=500, **kw):
+        '流式遍历匹配的所有结果'
+        # 用法:
+        #     async with aclosing(Blog.iter_all(where=..., batch=500)) as blogs:
+        #         async for blog in blogs: ...
+        # 通过服务器端游标每次取batch行,逐个生成对象,适合导出、重建索引等全表操作.
+        # aclosing(contextlib)保证中途break或出错时立即关闭游标、把连接还给连接池
+        sql, args, from_row = cls._select_sql(where, args, **kw)
+        async with aclosing(select_iter(sql, args, batch)) as it:
+            async for rs in it:
+                for r in rs:
+                    yield from_row(r)
+
+    @classmethod    # 类方法
+    async def find_many(cls, pks, fields=None, defer=None):
+        '通过一组主键查询,返回{主键: 对象}'
+        # 一条 where `id` in (...) 语句代替逐个find
+        pks = list(dict.fromkeys(pks))
+        if not pks:
+            return {}
+        select_sql, from_row = cls._projection(fields, defer)
+        rs = await select('%s where `%s` in (%s)' % (select_sql, cls.__primary_key__, create_args_string(len(pks))), pks)
+        return dict((r[cls.__primary_key__], from_row(r)) for r in rs)
+
+    @classmethod    # 类方法
+    async def prefetch(cls, parents, key, attr, **kw):
+        '一次查询出一组父对象关联的记录,以列表挂到每个父对象的attr上'
+        # 例如 await Comment.prefetch(blogs, 'blog_id', 'comments', orderBy='created_at desc')
+        # 其余关键字参数(orderBy, fields, defer)传给findAll
+        ids = list(dict.fromkeys(p[p.__primary_key__] for p in parents))
+        if not ids:
+            return []
+        items = await cls.findAll('`%s` in (%s)' % (key, create_args_string(len(ids))), ids, **kw)
+        groups = {}
+        for item in items:
+            groups.setdefault(item[key], []).append(item)
+        for p in parents:
+            p[attr] = groups.get(p[p.__primary_key__], [])
+        return items
+
+    @classmethod    # 类方法
+    async def prefetch_one(cls, children, key, attr, fields=None, defer=None):
+        '一次查询出一组子对象所属的记录,挂到每个子对象的attr上'
+        # 例如 await User.prefetch_one(comments, 'user_id', 'user'),关联不到的为None
+        found = await cls.find_many([c[key] for c in children if c.get(key) is not None], fields, defer)
+        for c in children:
+            c[attr] = found.get(c.get(key))
+        return found
+
+    @classmethod    # 类方法
+    async def count_by(cls, key, ids):
+        '一次查询出一组id各自的记录数,返回{id: 数量},没有记录的id为0'
+        # 例如 await Comment.count_by('blog_id', blog_ids) 得到每篇博客的评论数
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return {}
+        rs = await select('select `%s` _key_, count(`%s`) _num_ from `%s` where `%s` in (%s) group by `%s`' % (key, cls.__primary_key__, cls.__table__, key, create_args_string(len(ids)), key), ids)
+        counts = dict.fromkeys(ids, 0)
+        for r in rs:
+            counts[r['_key_']] = r['_num_']
+        return counts
 
     @classmethod    # 类方法
     async def findNumber(cls, selectField, where=None, args=None):
         '查询count的值'
         #根据WHERE条件查找，但返回的是整数，适用于select count(*)类型的SQL。
+        # 先查count缓存,命中则不必访问数据库
+        key = (selectField, where or None, tuple(args or ()))
+        num = _get_count(cls.__table__, key)
+        if num is not None:
+            return num
+        generation = _count_generation[cls.__table__]
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]   #_num_  别名,
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)  # size = 1
+        # 要放入缓存的结果从主库读取,副本上可能还没有同步最近的写入
+        if _count_ttl > 0 and _transaction.get() is None:
+            rs = await _select_primary(' '.join(sql), args, 1)
+        else:
+            rs = await select(' '.join(sql), args, 1)  # size = 1
         # 用于测试：
-        logging.info('findNumber rs: %s' % rs)
-        # INFO:root:findNumber rs: [{'_num_': 4}]
+        logging.debug('findNumber rs: %s', rs)
+        # DEBUG:root:findNumber rs: [{'_num_': 4}]
         if len(rs) == 0:
             return None
+        _put_count(cls.__table__, key, rs[0]['_num_'], generation)
         return rs[0]['_num_']  #
 
     @classmethod   # 类方法
-    async def find(cls, pk):
+    async def find(cls, pk, fields=None, defer=None, strict=False):
         '通过主键查询结果'
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)    #size = 1
+        select_sql, from_row = cls._projection(fields, defer)
+        # 取出全部字段时使用find缓存.strict为True时只使用在所有进程中一致的缓存(见cache.LocalCache的coherent),
+        # 用于不能接受其他worker中的修改延迟生效的场合,比如验证登录用户
+        if _find_cache is not None and fields is None and defer is None and _transaction.get() is None and (not strict or _find_cache.coherent):
+            key = '%s:%s' % (cls.__table__, pk)
+            row = await _find_cache.get(key)
+            if row is not None:
+                return from_row(row) if row else None
+            # 取得lease的请求从主库查询并写入缓存,查询期间该key被清除时lease作废,结果不写入;
+            # 不从副本读取,否则副本上还没有同步的旧数据会在缓存中保留ttl秒
+            token = await _find_cache.lease(key)
+            if token is None:
+                rs = await select('%s where `%s`=?' % (select_sql, cls.__primary_key__), [pk], 1)
+                return from_row(rs[0]) if rs else None
+            rs = await _select_primary('%s where `%s`=?' % (select_sql, cls.__primary_key__), [pk], 1)
+            row = rs[0] if rs else {}
+            await _find_cache.fill(key, token, row, _find_options['ttl'] if row else _find_options['negative_ttl'])
+            return from_row(row) if row else None
+        rs = await select('%s where `%s`=?' % (select_sql, cls.__primary_key__), [pk], 1)    #size = 1
         # 用于测试：
-        logging.info('find rs: %s' % rs)
-        #INFO:root:find rs: [{'id': '001482808658778b514127d15b0467d8470dd35939c5cd9000',
+        logging.debug('find rs: %s', rs)
+        #DEBUG:root:find rs: [{'id': '001482808658778b514127d15b0467d8470dd35939c5cd9000',
         #                   'user_id': '0014794846276707349fe7cddc34b849f86e59a8cdb5e50000',
         #                   'user_name': 'zhangeli',
         #                   'user_image': 'http://www.gravatar.com/avatar/f312905fee0764595a7d940a57531dfb?d=mm&s=120',
@@ -303,7 +1026,7 @@ class Model(dict, metaclass=ModelMetaclass):
         #                   'created_at': 1482808658.77836}]
         if len(rs) == 0:
             return None
-        return cls(**rs[0])  #
+        return from_row(rs[0])  #
 
     # 实例方法
     async def save(self):
@@ -312,22 +1035,97 @@ class Model(dict, metaclass=ModelMetaclass):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
         rows = await execute(self.__insert__, args)
+        await _changed(self.__table__, rows, 'insert', (self,))
         if rows != 1:
-            logging.warn('failed to insert record: affected rows: %s' % rows)
+            logging.warning('failed to insert record: affected rows: %s', rows)
+
+    @classmethod    # 类方法
+    async def save_many(cls, objs, batch_size=100, batch_bytes=1024 * 1024):
+        'bulk insert'
+        # 基于元类生成的__insert__,拼接成 insert ... values (...), (...) 的多行插入语句,
+        # 每条语句最多batch_size行,参数的估计大小最多batch_bytes字节(单行超过时单独一条语句),
+        # 避免超过MySQL的max_allowed_packet(5.x默认4MB).所有语句在同一个连接和事务中执行
+        if batch_size <= 0 or batch_bytes <= 0:
+            raise ValueError('batch_size and batch_bytes must be positive: %s, %s' % (batch_size, batch_bytes))
+        objs = list(objs)
+        if not objs:
+            return 0
+        head, row = cls.__insert__.rsplit(' values ', 1)
+        stmts = []
+        args, n, size = [], 0, 0
+        for obj in objs:
+            # 每一行都使用getValueOrDefault获取默认值
+            values = list(map(obj.getValueOrDefault, cls.__fields__))
+            values.append(obj.getValueOrDefault(cls.__primary_key__))
+            row_size = sum(map(_arg_size, values))
+            if n and (n >= batch_size or size + row_size > batch_bytes):
+                stmts.append(('%s values %s' % (head, ', '.join([row] * n)), args))
+                args, n, size = [], 0, 0
+            args.extend(values)
+            n += 1
+            size += row_size
+        stmts.append(('%s values %s' % (head, ', '.join([row] * n)), args))
+        rows = await execute_many(stmts)
+        await _changed(cls.__table__, rows, 'insert', objs)
+        if rows != len(objs):
+            logging.warning('failed to insert records: affected rows: %s, expected: %s', rows, len(objs))
+        return rows
+
+    async def load_deferred(self):
+        '取出查询时没有取出的字段'
+        deferred = self.__dict__.pop('_deferred', None)
+        if not deferred:
+            return self
+        fields = [f for f in self.__fields__ if f in deferred]
+        rs = await select('select %s from `%s` where `%s`=?' % (', '.join(map(lambda f: '`%s`' % f, fields)), self.__table__, self.__primary_key__), [self.getValue(self.__primary_key__)], 1)
+        if rs:
+            dict.update(self, rs[0])
+        return self
 
     async def update(self):
         'update'
+        # 部分字段的对象直接update会把没有取出的字段写成NULL
+        if self.__dict__.get('_deferred'):
+            raise ValueError('cannot update %s with deferred fields: %s, call load_deferred() first' % (self.__class__.__name__, ', '.join(self.__dict__['_deferred'])))
         # 使用getValue获取值（肯定存在）
         args = list(map(self.getValue, self.__fields__))
         args.append(self.getValue(self.__primary_key__))
         rows = await execute(self.__update__, args)
+        await _changed(self.__table__, 0, 'update', (self,))
         if rows != 1:
-            logging.warn('failed to update by primary key: affected rows: %s' % rows)
+            logging.warning('failed to update by primary key: affected rows: %s', rows)
+
+    @classmethod
+    async def remove_where(cls, where, args=None):
+        'bulk delete'
+        # 一条delete语句删除所有匹配的记录,返回删除的行数.先查出这些记录,用于清除find缓存和通知监听者,
+        # 在事务中时这些都在提交之后一次完成
+        objs = await cls.findAll(where, args)
+        if not objs:
+            return 0
+        rows = await execute('delete from `%s` where %s' % (cls.__table__, where), args)
+        await _changed(cls.__table__, -rows, 'delete', objs)
+        return rows
+
+    async def update_fields(self, fields, where=None, args=None):
+        'update部分字段,返回受影响的行数'
+        # 只写入fields中的列,不会覆盖其他请求对别的列的修改;where为附加条件,比如只在某列没有变化时才写入
+        sql = 'update `%s` set %s where `%s`=?' % (self.__table__, ', '.join(map(lambda f: '`%s`=?' % (self.__mappings__[f].name or f), fields)), self.__primary_key__)
+        values = [self.getValue(f) for f in fields]
+        values.append(self.getValue(self.__primary_key__))
+        if where:
+            sql = '%s and %s' % (sql, where)
+            values.extend(args or ())
+        rows = await execute(sql, values)
+        if rows:
+            await _changed(self.__table__, 0, 'update', (self,))
+        return rows
 
     async def remove(self):
         'delete'
         # 使用getValue获取值（肯定存在）
         args = [self.getValue(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        await _changed(self.__table__, -rows, 'delete', (self,))
         if rows != 1:
-            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+            logging.warning('failed to remove by primary key: affected rows: %s', rows)
@@ -0,0 +1,32 @@
+'''
+Microbenchmark: build models from result rows and read their fields,
+cls(**r) + Model.__getattr__ (old path) vs. from_row + field accessors.
+
+    python3 orm_bench.py
+'''
+import time, timeit
+
+from orm import Model
+from models import Blog
+
+# 原来的实现: 通过cls(**r)构造,属性读取走Model.__getattr__
+class LegacyBlog(dict):
+    __getattr__ = Model.__getattr__
+
+ROWS = [dict(id='%050d' % i, user_id='u', user_name='name', user_image='about:blank', name='blog %s' % i, summary='summary', content='content', html_content='<p>content</p>', html_version='v', created_at=time.time()) for i in range(300)]
+
+def read(blogs):
+    for b in blogs:
+        b.id, b.name, b.summary, b.created_at, b.user_name
+
+def legacy():
+    read([LegacyBlog(**r) for r in ROWS])
+
+def current():
+    from_row = Blog.from_row
+    read([from_row(r) for r in ROWS])
+
+if __name__ == '__main__':
+    for name, fn in (('cls(**r) + __getattr__', legacy), ('from_row + FieldAccessor', current)):
+        t = min(timeit.repeat(fn, number=200, repeat=5)) / 200
+        print('%-26s %8.1f us per page of %s rows' % (name, t * 1e6, len(ROWS)))
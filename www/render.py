@@ -0,0 +1,122 @@
+'''
+Render blog content from markdown to html.
+'''
+import os, asyncio, hashlib, logging
+
+from concurrent.futures import ProcessPoolExecutor
+
+import markdown2
+
+# 渲染器版本. markdown2升级或渲染参数变化时版本随之改变,已保存的html会被重新渲染
+RENDER_VERSION = 'markdown2-%s' % markdown2.__version__
+
+# 渲染用的进程池,在第一次使用时创建(每个worker进程各自创建)
+_executor = None
+# 正在渲染的内容: 内容的hash -> Future,相同内容的并发请求只渲染一次
+_pending = {}
+_options = dict(cache_size=256, cache_chars=8*1024*1024, workers=2, timeout=3)
+# 渲染进程的pid -> 该进程最近一次渲染后的markdown2.render_cache_info()
+_process_stats = {}
+
+# 初始化渲染,开启markdown2的渲染缓存,热门博客在每个进程中只渲染一次
+# workers为渲染进程池的大小(0表示在事件循环中直接渲染),timeout为等待渲染的最长时间(秒).
+# 使用进程池时只在渲染进程中开启缓存,当前进程不渲染,开启了也不会用到
+def init(**kw):
+    _options.update(kw)
+    if _options['cache_size'] > 0 and _options['workers'] <= 0:
+        markdown2.enable_render_cache(_options['cache_size'], _options['cache_chars'])
+
+# 关闭渲染进程池
+def close():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+    _process_stats.clear()
+
+# 渲染缓存的统计信息: 使用进程池时是各渲染进程的合计,没有开启缓存时返回None
+def cache_stats():
+    if _options['cache_size'] <= 0:
+        return None
+    if _options['workers'] <= 0:
+        infos = [markdown2.render_cache_info()]
+    else:
+        infos = list(_process_stats.values())
+    infos = [info for info in infos if info is not None]
+    stats = dict(processes=len(infos), maxsize=_options['cache_size'], max_chars=_options['cache_chars'])
+    for name in ('hits', 'misses', 'evictions', 'size', 'chars'):
+        stats[name] = sum(info[name] for info in infos)
+    total = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / total if total else 0.0
+    return stats
+
+def _init_process(cache_size, cache_chars):
+    if cache_size > 0:
+        markdown2.enable_render_cache(cache_size, cache_chars)
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(_options['workers'], initializer=_init_process, initargs=(_options['cache_size'], _options['cache_chars']))
+    return _executor
+
+def render_markdown(text):
+    return markdown2.markdown(text)
+
+# 在渲染进程中执行,同时返回该进程的缓存统计
+def _render_in_process(text):
+    return render_markdown(text), os.getpid(), markdown2.render_cache_info()
+
+# 纯文本转成html,渲染失败或超时时用作降级的结果
+def text2html(text):
+    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
+    return ''.join(lines)
+
+async def _render_in_pool(text):
+    loop = asyncio.get_event_loop()
+    try:
+        html, pid, info = await loop.run_in_executor(_get_executor(), _render_in_process, text)
+        _process_stats[pid] = info
+        return html
+    except Exception as e:
+        # 进程池损坏(比如渲染进程被杀死)时丢弃,下次重新创建
+        logging.exception(e)
+        close()
+        return None
+
+# 在进程池中渲染markdown,不阻塞事件循环.超过timeout或渲染失败时返回None
+async def render_markdown_async(text):
+    if _options['workers'] <= 0:
+        return render_markdown(text)
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    fut = _pending.get(key)
+    if fut is None:
+        fut = _pending[key] = asyncio.ensure_future(_render_in_pool(text))
+        fut.add_done_callback(lambda f: _pending.pop(key, None))
+    try:
+        # shield: 一个请求超时不会取消其他请求正在等待的渲染
+        return await asyncio.wait_for(asyncio.shield(fut), _options['timeout'])
+    except asyncio.TimeoutError:
+        logging.warning('render markdown timeout (%s chars)', len(text))
+        return None
+
+# 渲染博客正文,html保存在html_content中,html_version记录渲染时使用的渲染器版本
+def render_blog(blog):
+    blog.html_content = render_markdown(blog.content)
+    blog.html_version = RENDER_VERSION
+    return blog
+
+# 异步渲染博客正文.渲染超时或失败时html_content为转义后的纯文本,html_version清空(之后仍然需要渲染),返回False
+async def render_blog_async(blog):
+    html = await render_markdown_async(blog.content)
+    if html is None:
+        blog.html_content = text2html(blog.content)
+        blog.html_version = None
+        return False
+    blog.html_content = html
+    blog.html_version = RENDER_VERSION
+    return True
+
+# 判断博客保存的html是否需要(重新)渲染
+def is_stale(blog):
+    return blog.get('html_content') is None or blog.get('html_version') != RENDER_VERSION
@@ -0,0 +1,37 @@
+'''
+Backfill the pre-rendered html of blogs.
+
+    python3 render_blogs.py           # 只渲染没有html或渲染器版本过期的博客
+    python3 render_blogs.py --force   # 重新渲染所有博客
+'''
+import sys, time
+import asyncio
+from contextlib import aclosing
+import logging; logging.basicConfig(level=logging.INFO)
+
+import orm
+from config import configs
+from models import Blog
+from render import render_blog, is_stale
+
+async def backfill(loop, force=False):
+    await orm.create_pool(loop=loop, **configs.db)
+    n = 0
+    try:
+        # 使用服务器端游标遍历,内存占用与博客数量无关;出错时aclosing立即关闭游标,close_pool才不会一直等待这个连接
+        async with aclosing(Blog.iter_all(orderBy='created_at')) as blogs:
+            async for blog in blogs:
+                if force or is_stale(blog):
+                    render_blog(blog)
+                    # 只写入html的两列和修改时间,不覆盖网站上同时进行的修改
+                    blog.updated_at = time.time()
+                    await blog.update_fields(('html_content', 'html_version', 'updated_at'), 'content=?', [blog.content])
+                    n = n + 1
+    finally:
+        # 停止预热、检查连接的后台任务并关闭所有连接
+        await orm.close_pool()
+    logging.info('rendered %s blogs.', n)
+
+loop = asyncio.get_event_loop()
+loop.run_until_complete(backfill(loop, '--force' in sys.argv))
+loop.close()
@@ -30,10 +30,17 @@ create table blogs (
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext,
+    `html_version` varchar(50),
     `created_at` real not null,
+    `updated_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
+-- 已有数据库的升级,之后运行 python3 render_blogs.py 渲染已有的博客:
+-- alter table blogs add column `html_content` mediumtext, add column `html_version` varchar(50);
+-- alter table blogs add column `updated_at` real not null default 0;
+-- update blogs set `updated_at`=`created_at`;
 
 create table comments (
     `id` varchar(50) not null,
@@ -0,0 +1,86 @@
+'''
+JSON serializer for API responses: uses orjson or ujson when installed, the standard json module otherwise.
+'''
+import json, logging
+
+from apis import Page, CursorPage
+
+# 分页对象直接转换成dict,Model本身就是dict,各种后端都能直接序列化,不需要default回调
+_PAGES = (Page, CursorPage)
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_default).encode('utf-8')
+
+# 只用于其他自定义对象,与原来的default=lambda o: o.__dict__ 兼容
+def _default(o):
+    return o.__dict__
+
+def _load_backend(name):
+    if name in ('auto', 'orjson'):
+        try:
+            import orjson
+            return 'orjson', lambda obj: orjson.dumps(obj, default=_default)
+        except ImportError:
+            if name == 'orjson':
+                raise
+    if name in ('auto', 'ujson'):
+        try:
+            import ujson
+            # ujson不支持default,分页对象已经预先转换
+            return 'ujson', lambda obj: ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+        except ImportError:
+            if name == 'ujson':
+                raise
+    return 'json', _json_dumps
+
+_options = dict(backend='auto', chunk_items=1000)
+backend, _dumps = _load_backend('auto')
+
+def init(**kw):
+    '''
+    Select the json backend ('auto', 'orjson', 'ujson' or 'json') and the streaming threshold.
+    '''
+    global backend, _dumps
+    _options.update(kw)
+    backend, _dumps = _load_backend(_options['backend'])
+    logging.info('json backend: %s', backend)
+
+def _prepare(obj):
+    if isinstance(obj, dict):
+        for v in obj.values():
+            if isinstance(v, _PAGES):
+                return dict((k, v.__dict__ if isinstance(v, _PAGES) else v) for k, v in obj.items())
+        return obj
+    if isinstance(obj, _PAGES):
+        return obj.__dict__
+    return obj
+
+# 序列化为utf-8编码的bytes
+def dumps(obj):
+    return _dumps(_prepare(obj))
+
+# 是否有条目很多的列表,需要分块输出
+def should_stream(obj):
+    n = _options['chunk_items']
+    if n <= 0 or not isinstance(obj, dict):
+        return False
+    return any(isinstance(v, (list, tuple)) and len(v) > n for v in obj.values())
+
+# 分块序列化: 大的列表每chunk_items条输出一块,不必在内存中生成完整的json
+def iter_dumps(obj):
+    n = _options['chunk_items']
+    obj = _prepare(obj)
+    yield b'{'
+    first = True
+    for k, v in obj.items():
+        prefix = (b'' if first else b',') + _dumps(k) + b':'
+        first = False
+        if isinstance(v, (list, tuple)) and len(v) > n:
+            yield prefix + b'['
+            for i in range(0, len(v), n):
+                # 整块序列化成列表再去掉两端的[]
+                yield (b',' if i else b'') + _dumps(list(v[i:i+n]))[1:-1]
+            yield b']'
+        else:
+            yield prefix + _dumps(v)
+    yield b'}'